@@ -0,0 +1,222 @@
+'''
+benchmarks for the query builder and adapter hot paths, results are printed as a table and written as json
+
+    python benchmarks/bench.py compile --output compile.json
+    python benchmarks/bench.py db --config tests/test_config.json --concurrency 50 --pool-size 10 --output db.json
+    python benchmarks/bench.py compare old.json new.json
+
+compile needs no database, db creates and drops a bench_rows table on the configured database
+'''
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncpg  # noqa: E402
+
+from trelliopg import DBAdapter, get_db_settings  # noqa: E402
+from trelliopg.sql import _compile_where, _where_shape  # noqa: E402
+
+TABLE = 'bench_rows'
+
+WHERE_SHAPES = {
+    'eq': {'id': 1},
+    'eq_3': {'id': 1, 'name': 'a', 'value': 3},
+    'in': {'id__in': [1, 2, 3, 4, 5]},
+    'range': {'value__gte': 1, 'value__lt': 10, 'name__istartswith': 'a'},
+    'null': {'name': None, 'value__gt': 1},
+    'search': {'search': {'columns': ['name', 'body'], 'term': 'abc'}, 'value': 1},
+    'fulltext': {'search': {'columns': ['name', 'body'], 'term': 'abc', 'mode': 'fulltext', 'rank': True}},
+}
+
+
+def _environment() -> dict:
+    return {'python': platform.python_version(), 'implementation': platform.python_implementation(),
+            'asyncpg': asyncpg.__version__, 'platform': platform.platform(),
+            'timestamp': datetime.datetime.utcnow().isoformat() + 'Z'}
+
+
+def _timeit(func, number: int, repeat: int) -> float:
+    '''
+    :return: best seconds per call over repeat runs
+    '''
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def bench_compile(number: int = 20000, repeat: int = 5) -> list:
+    results = []
+    for name, where_dict in sorted(WHERE_SHAPES.items()):
+        shape, _ = _where_shape(where_dict, 10, 20, 'id desc')
+
+        def cached():
+            DBAdapter._where_query(where_dict, offset=10, limit=20, order_by='id desc')
+
+        def cold():
+            _compile_where.__wrapped__(*shape)
+
+        def select():
+            DBAdapter._select_query(TABLE, 'id,name', where_dict, 10, 20, 'id desc')
+
+        for variant, func in (('where', cached), ('compile_uncached', cold), ('select', select)):
+            seconds = _timeit(func, number, repeat)
+            results.append({'name': '{}.{}'.format(variant, name), 'ns_per_op': round(seconds * 1e9, 1),
+                            'ops_per_sec': round(1 / seconds)})
+    return results
+
+
+def _latency_stats(name: str, latencies: list, elapsed: float) -> dict:
+    latencies.sort()
+
+    def percentile(p):
+        return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 3) if latencies else None
+
+    return {'name': name, 'ops': len(latencies), 'ops_per_sec': round(len(latencies) / elapsed, 1),
+            'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3) if latencies else None,
+            'p50_ms': percentile(0.5), 'p95_ms': percentile(0.95), 'p99_ms': percentile(0.99),
+            'max_ms': round(latencies[-1] * 1000, 3) if latencies else None}
+
+
+async def _run_workers(operation, concurrency: int, duration: float) -> tuple:
+    latencies = []
+    deadline = time.monotonic() + duration
+
+    async def worker(worker_id):
+        i = 0
+        while time.monotonic() < deadline:
+            started = time.monotonic()
+            await operation(worker_id, i)
+            latencies.append(time.monotonic() - started)
+            i += 1
+
+    started = time.monotonic()
+    await asyncio.gather(*[worker(i) for i in range(concurrency)])
+    return latencies, time.monotonic() - started
+
+
+async def bench_db(settings: dict, concurrency: int, pool_size: int, duration: float, rows: int,
+                   operations: list) -> list:
+    settings = dict(settings)
+    settings['min_size'] = settings['max_size'] = pool_size
+    db = DBAdapter(**settings)
+
+    await db.execute(query='DROP TABLE IF EXISTS {};'.format(TABLE))
+    await db.execute(query='CREATE TABLE {} (id serial primary key, name text, value int, '
+                           'created timestamp default now());'.format(TABLE))
+    await db.insert_many(table=TABLE, rows=[{'name': 'row{}'.format(i), 'value': i % 100} for i in range(rows)])
+    await db.execute(query='ANALYZE {};'.format(TABLE))
+
+    async def insert(worker_id, i):
+        await db.insert(table=TABLE, value_dict={'name': 'w{}'.format(worker_id), 'value': i % 100})
+
+    async def where(worker_id, i):
+        await db.where(TABLE, id=(worker_id * 7919 + i) % rows + 1)
+
+    async def select(worker_id, i):
+        await db.select(TABLE, limit=20, order_by='id desc', use_primary=True)
+
+    async def iterate(worker_id, i):
+        async for _ in db.iterate('SELECT * FROM {} WHERE value = $1'.format(TABLE), i % 100, prefetch=100):
+            pass
+
+    async def atomic(worker_id, i):
+        async with db.acquire() as con:
+            async with con.transaction():
+                record = await db.insert(con, TABLE, {'name': 'a{}'.format(worker_id), 'value': i % 100})
+                await db.update(con, TABLE, {'id': record['id']}, value=i % 100 + 1)
+
+    available = {'insert': insert, 'where': where, 'select': select, 'iterate': iterate, 'atomic': atomic}
+    results = []
+    try:
+        for name in operations:
+            latencies, elapsed = await _run_workers(available[name], concurrency, duration)
+            results.append(_latency_stats(name, latencies, elapsed))
+    finally:
+        await db.execute(query='DROP TABLE IF EXISTS {};'.format(TABLE))
+        await db.close()
+    return results
+
+
+def compare(old: dict, new: dict) -> list:
+    '''
+    :return: per benchmark ratio new / old of ns_per_op (compile) or p50_ms (db), > 1 is slower
+    '''
+    metric = 'ns_per_op' if new['suite'] == 'compile' else 'p50_ms'
+    old_results = {result['name']: result for result in old['results']}
+    rows = []
+    for result in new['results']:
+        before = old_results.get(result['name'])
+        if before and before.get(metric) and result.get(metric):
+            rows.append({'name': result['name'], 'old': before[metric], 'new': result[metric],
+                         'ratio': round(result[metric] / before[metric], 3)})
+    return rows
+
+
+def _print_table(rows: list):
+    if not rows:
+        return
+    columns = list(rows[0].keys())
+    widths = [max(len(str(column)), *(len(str(row[column])) for row in rows)) for column in columns]
+    print('  '.join(str(column).ljust(width) for column, width in zip(columns, widths)).rstrip())
+    for row in rows:
+        print('  '.join(str(row[column]).ljust(width) for column, width in zip(columns, widths)).rstrip())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command')
+
+    compile_parser = commands.add_parser('compile', help='sql compilation microbenchmarks, no database needed')
+    compile_parser.add_argument('--number', type=int, default=20000)
+    compile_parser.add_argument('--repeat', type=int, default=5)
+    compile_parser.add_argument('--output')
+
+    db_parser = commands.add_parser('db', help='end to end benchmarks against a local postgres')
+    db_parser.add_argument('--config', default=os.environ.get('CONFIG_FILE', './tests/test_config.json'))
+    db_parser.add_argument('--database', default='default', help='name in DATABASE_SETTINGS')
+    db_parser.add_argument('--concurrency', type=int, default=20)
+    db_parser.add_argument('--pool-size', type=int, default=10)
+    db_parser.add_argument('--duration', type=float, default=5, help='seconds per operation')
+    db_parser.add_argument('--rows', type=int, default=10000, help='rows seeded before the run')
+    db_parser.add_argument('--operations', default='insert,where,select,iterate,atomic')
+    db_parser.add_argument('--output')
+
+    compare_parser = commands.add_parser('compare', help='compare two result files')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+
+    args = parser.parse_args(argv)
+    if args.command == 'compare':
+        with open(args.old) as old, open(args.new) as new:
+            _print_table(compare(json.load(old), json.load(new)))
+        return
+
+    if args.command == 'compile':
+        params = {'number': args.number, 'repeat': args.repeat}
+        results = bench_compile(args.number, args.repeat)
+    elif args.command == 'db':
+        params = {'concurrency': args.concurrency, 'pool_size': args.pool_size, 'duration': args.duration,
+                  'rows': args.rows}
+        loop = asyncio.get_event_loop()
+        results = loop.run_until_complete(bench_db(get_db_settings(args.config, args.database), args.concurrency,
+                                                   args.pool_size, args.duration, args.rows,
+                                                   args.operations.split(',')))
+    else:
+        parser.print_help()
+        return
+
+    _print_table(results)
+    if args.output:
+        report = {'suite': args.command, 'params': params, 'environment': _environment(), 'results': results}
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,4 +7,5 @@ setup(name='trelliopg',
       url='https://github.com/zoniclabs/trelliopg',
       description='A fast database connector and micro-orm for postgresql',
       packages=['trelliopg'],
-      install_requires=['asyncpg'])
+      install_requires=['asyncpg'],
+      extras_require={'columnar': ['numpy']})
@@ -1,10 +1,25 @@
+import asyncio
+import datetime
+import decimal
+import json
 import os
+import struct
 
 import pytest
 from asyncpg.exceptions import DuplicateTableError, UndefinedTableError
-from trelliopg.sql import async_atomic_func, AtomicExceptionHandler
+from trelliopg.advisor import PlanAdvisor, QueryShape, filter_columns, pattern_columns
+from trelliopg.cache import MISS, ResultCache, written_tables
+from trelliopg.codecs import json_encode, json_loads, map_rows
+from trelliopg.columnar import BinaryCopyParser, ColumnStream, COPY_SIGNATURE
+from trelliopg.loader import BatchLoader
+from trelliopg.notify import notify_trigger_ddl
+from trelliopg.pool import Admission, PoolOverloadedError, PRIORITY_BACKGROUND, PRIORITY_CRITICAL, PRIORITY_NORMAL
+from trelliopg.sql import async_atomic_func, AtomicExceptionHandler, _compile_where, encode_keyset_token, \
+    decode_keyset_token, _call_options, _column_batches, WHERE_OPTIONS
+from trelliopg.writer import BufferedWriter
 
-from trelliopg import get_db_adapter, PY_36, async_atomic
+from trelliopg import get_db_adapter, PY_36, async_atomic, DBAdapter, Metrics, ShardedAdapter, create_db_adapter, \
+    get_db_settings
 
 os.environ['CONFIG_FILE'] = './tests/test_config.json'
 
@@ -140,3 +155,768 @@ async def test_async_atomic_decorators():
 
     await foo().test_atomic_decorator()
 
+
+
+@pytest.mark.asyncio
+async def test_insert_many(pg):
+    await pg.execute(query='DROP TABLE IF EXISTS test_insert_many;')
+    await pg.execute(query='CREATE TABLE test_insert_many (id serial primary key, name text, value int);')
+
+    rows = [{'name': 'row{}'.format(i), 'value': i} for i in range(25)]
+    assert await pg.insert_many(table='test_insert_many', rows=rows, chunk_size=10) == 25
+
+    results = await pg.insert_many(table='test_insert_many', rows=[('a', 1), ('b', 2)], columns=['name', 'value'],
+                                   returning='id')
+    assert [r['id'] for r in results] == [26, 27]
+
+    pool = await pg.get_pool()
+    async with pool.acquire() as con:
+        async with con.transaction():
+            for name in ('c', 'd'):
+                results = await pg.insert_many(con, 'test_insert_many', rows=[(name, 3)], columns=['name', 'value'],
+                                               returning='id')
+                assert len(results) == 1
+
+
+def test_where_query_placeholders():
+    query, args = DBAdapter._where_query({'id__in': [1, 2], 'name__istartswith': 'ab', 'deleted': None},
+                                         offset=10, limit=5, order_by='id')
+    assert query == ' where id = any($1) and name ilike $2 and deleted is null order by id offset $3 limit $4'
+    assert args == [[1, 2], 'ab%', 10, 5]
+
+    query, args = DBAdapter._where_query({'search': {'columns': ['name', 'code__startswith'], 'term': 'x'}, 'id': 3},
+                                         update_query=True, start=2)
+    assert query == ' where (name ilike $2 or code like $3) and (id = $4) '
+    assert args == ['%x%', 'x%', 3]
+
+
+def test_select_query_without_order():
+    query, args = DBAdapter._select_query('users', '*', None, 0, None, None)
+    assert query == 'SELECT * FROM users' and args == []
+
+
+def test_where_query_null_lookups():
+    query, args = DBAdapter._where_query({'a': None, 'b': 2})
+    assert query == ' where a is null and b = $1' and args == [2]
+    with pytest.raises(ValueError):
+        DBAdapter._where_query({'a__gte': None, 'b': 2})
+
+
+def test_where_query_shape_cache():
+    DBAdapter._where_query({'id': 1})
+    hits = _compile_where.cache_info().hits
+    query, args = DBAdapter._where_query({'id': 2})
+    assert _compile_where.cache_info().hits == hits + 1
+    assert args == [2]
+
+
+def test_search_modes():
+    search = {'columns': ['title', 'body'], 'term': 'cats', 'mode': 'fulltext', 'rank': True}
+    query, args = DBAdapter._where_query({'search': search, 'lang': 'en'}, order_by='id', limit=10)
+    vector = "to_tsvector('english', coalesce(title, '') || ' ' || coalesce(body, ''))"
+    assert "{} @@ websearch_to_tsquery('english', $1)".format(vector) in query
+    assert 'lang = $2' in query
+    assert "order by ts_rank({}, websearch_to_tsquery('english', $1)) desc,id limit $3".format(vector) in query
+    assert args == ['cats', 'en', 10]
+
+    search = {'columns': ['name', 'nick'], 'term': 'jon', 'mode': 'trigram', 'rank': True}
+    query, args = DBAdapter._where_query({'search': search}, update_query=True)
+    assert query.strip() == 'where name % $1 or nick % $1'
+    assert args == ['jon']
+
+    with pytest.raises(ValueError):
+        DBAdapter._where_query({'search': {'columns': ['name'], 'term': 'x', 'mode': 'fulltext', 'config': "x')"}})
+
+
+def test_replica_params():
+    adapter = DBAdapter(database='db', user='u', password='p', replicas=['replica1', 'replica2:5433'])
+    assert len(adapter.replicas) == 2
+    assert adapter.replicas._params_list[0]['dsn'] == 'postgres://u:p@replica1:5432/db'
+    assert adapter.replicas._params_list[1]['dsn'] == 'postgres://u:p@replica2:5433/db'
+    assert adapter._params['dsn'] == 'postgres://u:p@localhost:5432/db'
+
+
+def test_keyset_token():
+    values = [datetime.datetime(2017, 5, 1, 10, 30), decimal.Decimal('1.5'), 7, 'abc']
+    assert decode_keyset_token(encode_keyset_token(values)) == values
+
+
+@pytest.mark.asyncio
+async def test_keyset_pagination(pg):
+    await pg.execute(query='DROP TABLE IF EXISTS test_keyset;')
+    await pg.execute(query='CREATE TABLE test_keyset (id serial primary key, value int);')
+    await pg.insert_many(table='test_keyset', rows=[{'value': i % 3} for i in range(10)])
+
+    rows, token = await pg.keyset('test_keyset', order_by='id', limit=4)
+    assert [r['id'] for r in rows] == [1, 2, 3, 4]
+    rows, token = await pg.keyset('test_keyset', order_by='id', after=token, limit=4)
+    assert [r['id'] for r in rows] == [5, 6, 7, 8]
+    rows, token = await pg.keyset('test_keyset', order_by='id', after=token, limit=4)
+    assert [r['id'] for r in rows] == [9, 10] and token is None
+
+    pages = []
+    async for page in pg.paginate('test_keyset', order_by='value desc, id', page_size=3, where_dict={'value__gte': 1}):
+        pages.append(page)
+    assert [len(page) for page in pages] == [3, 3]
+
+
+def test_result_cache():
+    cache = ResultCache(max_entries=2, default_ttl=60, table_ttls={'logs': None})
+    query = 'SELECT * FROM t where id = $1'
+
+    cache.set('t', query, [1], [{'id': 1}], cache.generation('t'))
+    assert cache.get('t', query, [1]) == [{'id': 1}]
+    assert cache.get('t', query, [2]) is MISS
+
+    generation = cache.generation('t')
+    cache.invalidate(written_tables('UPDATE t SET a = 1'))
+    cache.set('t', query, [2], [{'id': 2}], generation)
+    assert cache.get('t', query, [1]) is MISS and cache.get('t', query, [2]) is MISS
+
+    for i in range(3):
+        cache.set('t', query, [i], [], cache.generation('t'))
+    cache.set('logs', query, [1], [], cache.generation('logs'))
+    assert cache.stats()['entries'] == 2 and cache.stats()['evictions'] == 1
+
+
+@pytest.mark.asyncio
+async def test_batch_loader(pg):
+    await pg.execute(query='DROP TABLE IF EXISTS test_loader;')
+    await pg.execute(query='CREATE TABLE test_loader (id serial primary key, name text);')
+    await pg.insert_many(table='test_loader', rows=[{'name': 'row{}'.format(i)} for i in range(5)])
+
+    rows = await asyncio.gather(*[pg.load('test_loader', i) for i in (1, 2, 2, 9)])
+    assert [row['name'] if row else None for row in rows] == ['row0', 'row1', 'row1', None]
+
+
+def test_metrics():
+    slow = []
+    metrics = Metrics(slow_query_threshold=0.5, on_slow_query=lambda *args: slow.append(args))
+    metrics.acquire(0.003)
+    metrics.query('where', 'users', 'SELECT * FROM users', 0.01, rows=3)
+    metrics.query('update', 'users', 'UPDATE users SET name=$1', 0.75, rows=1)
+
+    assert metrics.latency[('where', 'users')].count == 1
+    assert metrics.rows[('where', 'users')] == 3
+    assert slow == [('update', 'users', 'UPDATE users SET name=$1', 0.75)]
+
+    text = metrics.to_prometheus()
+    assert 'trelliopg_pool_acquire_seconds_count 1' in text
+    assert 'trelliopg_query_seconds_bucket{method="where",table="users",le="0.01"} 1' in text
+
+    def failing_callback(*args):
+        raise RuntimeError
+
+    metrics.on_slow_query = failing_callback
+    metrics.query('where', 'users', 'SELECT * FROM users', 2.0, error='QueryCanceledError')
+    assert metrics.callback_errors == 1
+    assert metrics.latency[('where', 'users')].count == 2
+    assert 'trelliopg_query_errors_total{method="where",table="users",error="QueryCanceledError"} 1' in \
+        metrics.to_prometheus()
+
+
+def test_timed_records_failures():
+    adapter = DBAdapter(instrumentation={})
+    with pytest.raises(ValueError):
+        with adapter._timed('update', 'users', 'UPDATE users SET name=$1'):
+            raise ValueError
+    assert adapter.metrics.errors[('update', 'users', 'ValueError')] == 1
+    assert adapter.metrics.latency[('update', 'users')].count == 1
+
+
+def test_metrics_label_escaping():
+    metrics = Metrics()
+    metrics.query('where', '(select * from t where name = \'a\\b "c"\n) t', 'q', 0.01, rows=1)
+    assert 'table="(select * from t where name = \'a\\\\b \\"c\\"\\n) t"' in metrics.to_prometheus()
+
+
+@pytest.mark.asyncio
+async def test_stream_and_export(pg, tmpdir):
+    batches = []
+    async for batch in pg.stream('SELECT * FROM generate_series(1, 10) AS n', batch_size=4):
+        batches.append([r['n'] for r in batch])
+    assert batches == [[1, 2, 3, 4], [5, 6, 7, 8], [9, 10]]
+
+    path = str(tmpdir.join('export.csv'))
+    await pg.export(path, query='SELECT * FROM generate_series(1, 3) AS n')
+    with open(path) as f:
+        assert f.read().split() == ['n', '1', '2', '3']
+
+
+@pytest.mark.asyncio
+async def test_autocommit(pg):
+    await pg.execute(query='DROP TABLE IF EXISTS test_autocommit;', autocommit=True)
+    await pg.execute(query='CREATE TABLE test_autocommit (id serial primary key, name text);', autocommit=True)
+
+    row = await pg.insert(table='test_autocommit', value_dict={'name': 'a'}, autocommit=True)
+    rows = await pg.update(table='test_autocommit', where_dict={'id': row['id']}, options={'autocommit': True},
+                           name='b')
+    assert rows[0]['name'] == 'b'
+    await pg.delete(table='test_autocommit', where_dict={'id': row['id']}, autocommit=True)
+    assert await pg.where('test_autocommit', options={'use_primary': True}) == []
+
+
+@pytest.mark.asyncio
+async def test_upsert_and_update_many(pg):
+    await pg.execute(query='DROP TABLE IF EXISTS test_upsert;')
+    await pg.execute(query='CREATE TABLE test_upsert (id int primary key, name text, value int);')
+
+    rows = [{'id': i, 'name': 'row{}'.format(i), 'value': i} for i in range(5)]
+    assert await pg.upsert(table='test_upsert', rows=rows, conflict_columns=['id'], batch_size=2) == 5
+
+    rows = [{'id': 4, 'name': 'new4', 'value': 40}, {'id': 5, 'name': 'row5', 'value': 5}]
+    results = await pg.upsert(table='test_upsert', rows=rows, conflict_columns=['id'], returning='id,name')
+    assert sorted(tuple(r) for r in results) == [(4, 'new4'), (5, 'row5')]
+
+    rows = [(0, 100), (1, 101)]
+    assert await pg.update_many(table='test_upsert', rows=rows, key_columns=['id'], columns=['id', 'value']) == 2
+    assert [r['value'] for r in await pg.where('test_upsert', order_by='id', options={'use_primary': True})] == \
+        [100, 101, 2, 3, 40, 5]
+
+    rows = [{'id': 2, 'name': 'first', 'value': 1}, {'id': 2, 'name': 'last', 'value': 2}]
+    assert await pg.upsert(table='test_upsert', rows=rows, conflict_columns=['id']) == 1
+    assert (await pg.where('test_upsert', options={'use_primary': True}, id=2))[0]['name'] == 'last'
+
+
+def test_update_many_and_upsert_rows():
+    adapter = DBAdapter()
+    loop = asyncio.new_event_loop()
+    with pytest.raises(ValueError):
+        loop.run_until_complete(adapter.update_many(table='t', rows=[(1,)], columns=['id']))
+    with pytest.raises(ValueError):
+        loop.run_until_complete(adapter.update_many(table='t', rows=[(1, 'a')], columns=['name', 'value']))
+
+    columns, batches = _column_batches([(1, 'a'), (2, 'b'), (1, 'c')], ['id', 'name'], 2, unique=('id',))
+    assert batches == [[(2, 'b'), (1, 'c')]]
+
+
+@pytest.mark.asyncio
+async def test_single_flight_pool_and_warm_up(pg):
+    pg.pool = None
+    pools = await asyncio.gather(*[pg.get_pool() for _ in range(10)])
+    assert len(set(id(pool) for pool in pools)) == 1
+
+    await pg.warm_up(statements=['SELECT * FROM sqrt($1::float8)'])
+    assert 'SELECT * FROM sqrt($1::float8)' in pg.statements
+
+
+@pytest.mark.asyncio
+async def test_admission_priority_and_overload():
+    admission = Admission(1, max_waiters=1)
+    await admission.acquire()
+
+    served = []
+
+    async def waiter(priority, name):
+        await admission.acquire(priority)
+        served.append(name)
+        admission.release()
+
+    background = asyncio.ensure_future(waiter(PRIORITY_BACKGROUND, 'background'))
+    await asyncio.sleep(0)
+    with pytest.raises(PoolOverloadedError):
+        await admission.acquire(PRIORITY_NORMAL)
+
+    critical = asyncio.ensure_future(waiter(PRIORITY_CRITICAL, 'critical'))
+    await asyncio.sleep(0)
+    admission.release()
+    await asyncio.gather(background, critical)
+    assert served == ['critical', 'background']
+
+
+def test_sharded_routing_and_merge():
+    sharded = create_db_adapter({'shards': [{'host': 'shard0'}, {'host': 'shard1'}, {'host': 'shard2'}],
+                                 'shard_key': 'tenant_id', 'bounds': [100, 200], 'database': 'db'})
+    assert isinstance(sharded, ShardedAdapter)
+    assert sharded.shards[1]._params['dsn'] == 'postgres://:@shard1:5432/db'
+    assert [sharded.shard_index(v) for v in (5, 100, 199, 1000)] == [0, 1, 1, 2]
+
+    targets = sharded._targets({'tenant_id__in': [1, 150, 2], 'name': 'x'})
+    assert targets == {0: {'tenant_id__in': [1, 2], 'name': 'x'}, 1: {'tenant_id__in': [150], 'name': 'x'}}
+    assert list(sharded._targets({'name': 'x'}).keys()) == [0, 1, 2]
+
+    results = [[{'id': 1}, {'id': 4}], [{'id': 2}, {'id': 3}]]
+    assert ShardedAdapter._merge(results, offset=1, limit=2, order_by='id') == [{'id': 2}, {'id': 3}]
+    results = [[{'a': 1, 'id': 2}, {'a': 2, 'id': 1}], [{'a': 1, 'id': 1}]]
+    assert ShardedAdapter._merge(results, order_by='a desc, id') == [{'a': 2, 'id': 1}, {'a': 1, 'id': 1},
+                                                                   {'a': 1, 'id': 2}]
+
+    results = [[{'a': 1}, {'a': None}], [{'a': 2}]]
+    assert ShardedAdapter._merge(results, order_by='a') == [{'a': 1}, {'a': 2}, {'a': None}]
+    results = [[{'a': None}, {'a': 1}], [{'a': 2}]]
+    assert ShardedAdapter._merge(results, order_by='a desc') == [{'a': None}, {'a': 2}, {'a': 1}]
+
+    inserted = []
+
+    class Shard:
+        def __init__(self, index):
+            self.index = index
+
+        async def insert_many(self, con, table, rows, columns, chunk_size, **kwargs):
+            inserted.append((self.index, list(rows), columns))
+            return len(rows)
+
+    async def rows():
+        for tenant_id in (5, 150, 6):
+            yield {'tenant_id': tenant_id, 'name': 'x'}
+
+    sharded.shards = [Shard(0), Shard(1), Shard(2)]
+    count = asyncio.new_event_loop().run_until_complete(sharded.insert_many(table='t', rows=rows(), chunk_size=2))
+    assert count == 3
+    assert inserted == [(0, [(5, 'x')], ['tenant_id', 'name']), (1, [(150, 'x')], ['tenant_id', 'name']),
+                        (0, [(6, 'x')], ['tenant_id', 'name'])]
+
+    con = object()
+    assert ShardedAdapter._connections(con, [1]) == {1: con}
+    assert ShardedAdapter._connections({0: con}, [0, 2]) == {0: con}
+    with pytest.raises(ValueError):
+        ShardedAdapter._connections(con, [0, 2])
+    with pytest.raises(TypeError):
+        sharded.acquire()
+
+
+@pytest.mark.asyncio
+async def test_count_exists_aggregate(pg):
+    await pg.execute(query='DROP TABLE IF EXISTS test_aggregate;')
+    await pg.execute(query='CREATE TABLE test_aggregate (id serial primary key, status text, amount int);')
+    await pg.insert_many(table='test_aggregate', rows=[('a', 1), ('a', 2), ('b', 10)], columns=['status', 'amount'])
+
+    assert await pg.count('test_aggregate', use_primary=True) == 3
+    assert await pg.count('test_aggregate', {'amount__gte': 2}, use_primary=True) == 2
+    assert await pg.exists('test_aggregate', {'status': 'b'}, use_primary=True)
+    assert not await pg.exists('test_aggregate', {'status': 'c'}, use_primary=True)
+
+    groups = await pg.aggregate('test_aggregate', {'total': ('sum', 'amount'), 'n': ('count', '*')},
+                                group_by=['status'], order_by='status', use_primary=True)
+    assert [tuple(g) for g in groups] == [('a', 2, 3), ('b', 1, 10)]
+    assert (await pg.aggregate('test_aggregate', {'top': ('max', 'amount')}, use_primary=True))['top'] == 10
+    assert (await pg.aggregate('test_aggregate', use_primary=True))['count'] == 3
+    assert await pg.estimated_count('test_aggregate', {'status': 'a'}) >= 0
+
+
+@pytest.mark.asyncio
+async def test_returning_and_deferred_columns(pg):
+    await pg.execute(query='DROP TABLE IF EXISTS test_returning;')
+    await pg.execute(query='CREATE TABLE test_returning (id serial primary key, name text, payload jsonb);')
+
+    row = await pg.insert(table='test_returning', value_dict={'name': 'a', 'payload': '{}'}, returning='id')
+    assert list(row.keys()) == ['id']
+    assert await pg.insert(table='test_returning', value_dict={'name': 'b'}, returning=False) is None
+    assert await pg.update(table='test_returning', where_dict={'name': 'b'}, options={'returning': False},
+                           name='c') == 1
+
+    deleted = await pg.delete(table='test_returning', where_dict={'name': 'c'}, returning=['id'])
+    assert [r['id'] for r in deleted] == [2]
+
+    pg.deferred['test_returning'] = ['payload']
+    try:
+        rows = await pg.where('test_returning', options={'use_primary': True})
+        assert list(rows[0].keys()) == ['id', 'name']
+        rows = await pg.where('test_returning', options={'use_primary': True, 'undefer': ['payload']})
+        assert list(rows[0].keys()) == ['id', 'name', 'payload']
+    finally:
+        del pg.deferred['test_returning']
+
+
+def test_map_rows():
+    records = [{'id': 1, 'name': 'a'}, {'id': 2, 'name': 'b'}]
+
+    class Record(dict):
+        def __iter__(self):
+            return iter(self.values())
+
+    records = [Record(r) for r in records]
+    rows = map_rows(records)
+    assert (rows[0].id, rows[1].name) == (1, 'b')
+    assert not hasattr(rows[0], '__dict__')
+    assert type(rows[0]) is type(map_rows(records)[0])
+    assert map_rows(records, 'tuple') == [(1, 'a'), (2, 'b')]
+    assert map_rows(records, 'namedtuple')[1].name == 'b'
+
+
+@pytest.mark.asyncio
+async def test_json_codecs():
+    adapter = DBAdapter(**get_db_settings(), json_codecs=True)
+    row = await adapter.where('(SELECT \'{"a": [1, 2]}\'::jsonb AS doc) AS t', options={'use_primary': True})
+    assert row[0]['doc'] == {'a': [1, 2]}
+
+    await adapter.execute(query='DROP TABLE IF EXISTS test_json;')
+    await adapter.execute(query='CREATE TABLE test_json (id serial primary key, doc jsonb);')
+    await adapter.insert(table='test_json', value_dict={'doc': '{"a": 1}'})
+    await adapter.insert(table='test_json', value_dict={'doc': {'b': 2}})
+    rows = await adapter.where('test_json', order_by='id', options={'use_primary': True})
+    assert [row['doc'] for row in rows] == [{'a': 1}, {'b': 2}]
+    await adapter.pool.close()
+
+
+def test_json_encode_keeps_serialized_text():
+    assert json_encode('{"a": 1}') == '{"a": 1}'
+    assert json_loads(json_encode({'a': [1, None]})) == {'a': [1, None]}
+
+
+@pytest.mark.asyncio
+async def test_buffered_writer(pg):
+    await pg.execute(query='DROP TABLE IF EXISTS test_writer;')
+    await pg.execute(query='CREATE TABLE test_writer (id serial primary key, event text);')
+
+    writer = BufferedWriter(pg, max_rows=3, flush_interval=0.05, max_buffered=4, overflow='drop_newest',
+                            method='insert')
+    assert all([writer.write('test_writer', {'event': 'e{}'.format(i)}) for i in range(4)])
+    assert not writer.write('test_writer', {'event': 'dropped'})
+    assert writer.queue_depth() == {'test_writer': 4}
+
+    await writer.close()
+    assert writer.stats()['written'] == 4 and writer.dropped == 1
+    assert await pg.count('test_writer') == 4
+    with pytest.raises(RuntimeError):
+        writer.write('test_writer', {'event': 'late'})
+
+
+def test_notify_trigger_ddl():
+    ddl = notify_trigger_ddl('public.events', columns=['id', 'kind'])
+    assert "pg_notify('public_events_changes'" in ddl
+    assert "json_build_object('id', r.id, 'kind', r.kind)" in ddl
+    assert 'AFTER INSERT OR UPDATE OR DELETE ON public.events' in ddl
+    with pytest.raises(ValueError):
+        notify_trigger_ddl('events', channel="x'); DROP TABLE events; --")
+
+
+@pytest.mark.asyncio
+async def test_change_feed(pg):
+    await pg.execute(query='DROP TABLE IF EXISTS test_feed;')
+    await pg.execute(query='CREATE TABLE test_feed (id serial primary key, name text);')
+    channel = await pg.notify_trigger('test_feed')
+
+    async with await pg.subscribe(channel, decode=json.loads) as changes:
+        await pg.insert(table='test_feed', value_dict={'name': 'a'})
+        await pg.delete(table='test_feed', where_dict={'name': 'a'})
+        inserted = await asyncio.wait_for(changes.get(), 5)
+        deleted = await asyncio.wait_for(changes.get(), 5)
+
+    assert (inserted['op'], inserted['row']['name']) == ('INSERT', 'a')
+    assert (deleted['table'], deleted['op']) == ('test_feed', 'DELETE')
+    await pg.drop_notify_trigger('test_feed')
+
+
+def test_binary_copy_parser():
+    numpy = pytest.importorskip('numpy')
+    data = COPY_SIGNATURE + struct.pack('>ii', 0, 0)
+    for i in range(100):
+        data += struct.pack('>h', 2) + struct.pack('>iq', 8, i)
+        data += struct.pack('>i', -1) if i == 50 else struct.pack('>id', 8, i / 2)
+    data += struct.pack('>h', -1)
+
+    parser = BinaryCopyParser(['id', 'value'], ['int8', 'float8'])
+    chunks = []
+    for start in range(0, len(data), 333):
+        chunks.extend(parser.feed(data[start:start + 333]))
+    assert parser.finished
+
+    ids = numpy.concatenate([arrays[0] for arrays, _ in chunks])
+    values = numpy.concatenate([arrays[1] for arrays, _ in chunks])
+    nulls = numpy.concatenate([masks[1] if masks[1] is not None else numpy.zeros(len(arrays[1]), bool)
+                               for arrays, masks in chunks])
+    assert ids.tolist() == list(range(100))
+    assert values[99] == 49.5 and values[50] == 0
+    assert nulls.nonzero()[0].tolist() == [50]
+
+
+def test_binary_copy_infinite_timestamps():
+    numpy = pytest.importorskip('numpy')
+    data = COPY_SIGNATURE + struct.pack('>ii', 0, 0)
+    for micros, days in ((0, 0), (2 ** 63 - 1, 2 ** 31 - 1), (-2 ** 63, -2 ** 31)):
+        data += struct.pack('>h', 2) + struct.pack('>iq', 8, micros) + struct.pack('>ii', 4, days)
+    data += struct.pack('>h', -1)
+
+    (arrays, masks), = BinaryCopyParser(['at', 'on'], ['timestamp', 'date']).feed(data)
+    for array in arrays:
+        assert array[0] == numpy.datetime64('2000-01-01')
+        assert array[1] == array.max() and array[2] == array.min()
+        assert not numpy.isnat(array).any()
+
+
+def test_column_stream_after_close():
+    pytest.importorskip('numpy')
+    stream = ColumnStream(None, 't', 'SELECT 1')
+
+    async def run():
+        await stream.close()
+        with pytest.raises(StopAsyncIteration):
+            await stream.__anext__()
+
+    asyncio.new_event_loop().run_until_complete(run())
+
+
+@pytest.mark.asyncio
+async def test_fetch_columns(pg):
+    pytest.importorskip('numpy')
+    await pg.execute(query='DROP TABLE IF EXISTS test_columns;')
+    await pg.execute(query='CREATE TABLE test_columns (id serial primary key, value float8, name text);')
+    await pg.insert_many(table='test_columns', rows=[{'value': i / 2 if i % 10 else None, 'name': str(i)}
+                                                     for i in range(250)])
+
+    batches = []
+    async for batch in pg.column_batches('test_columns', columns=['id', 'value'], batch_size=100, order_by='id'):
+        batches.append(len(batch))
+    assert batches == [100, 100, 50]
+
+    async with pg.column_batches('test_columns', columns=['id'], batch_size=10, order_by='id') as stream:
+        async for batch in stream:
+            break
+    assert stream._task.done()
+    with pytest.raises(StopAsyncIteration):
+        await stream.__anext__()
+
+    columns = await pg.fetch_columns('test_columns', columns=['id', 'value', 'name'], order_by='id',
+                                     where_dict={'id__lte': 20})
+    assert columns['id'].tolist() == list(range(1, 21))
+    assert columns.mask('value').nonzero()[0].tolist() == [0, 10]
+    assert columns['name'][3] == '3'
+
+
+def test_plan_advisor_analysis():
+    assert filter_columns("((value >= 1) AND (name ~~* '%a%'::text) AND (kind = ANY ($2)))") == \
+        ['kind', 'value']
+    assert pattern_columns("((value >= 1) AND (name ~~* '%a%'::text))") == {'name': 'trigram'}
+    assert filter_columns("((created)::date = '2017-01-01'::date)") == ['created']
+
+    advisor = PlanAdvisor(None, min_rows_removed=100)
+    shape = QueryShape('where', 'events', 'SELECT * FROM events where kind = $1')
+    plan = {'Node Type': 'Limit', 'Plans': [
+        {'Node Type': 'Seq Scan', 'Relation Name': 'events', 'Filter': '(kind = $1)', 'Rows Removed by Filter': 5000,
+         'Actual Loops': 1}]}
+    advisor.shapes[shape.query] = shape
+    advisor._analyze(shape, plan)
+
+    report = advisor.report()
+    assert report['seq_scans'] == {'events': 1}
+    candidate = report['index_candidates'][0]
+    assert (candidate['table'], candidate['columns'], candidate['rows_removed']) == ('events', ['kind'], 5000)
+    assert candidate['ddl'] == 'CREATE INDEX ON events (kind);'
+
+    advisor._analyze(shape, {'Node Type': 'Seq Scan', 'Relation Name': 'events', 'Rows Removed by Filter': 5000,
+                             'Filter': "(name ~~* '%a%'::text)"})
+    assert [c['ddl'] for c in advisor.report()['index_candidates']] == [
+        'CREATE INDEX ON events (kind);', 'CREATE INDEX ON events USING gin (name gin_trgm_ops);']
+
+
+@pytest.mark.asyncio
+async def test_plan_capture():
+    adapter = DBAdapter(**get_db_settings(), plan_capture={'threshold': 0, 'min_rows_removed': 10})
+    await adapter.execute(query='DROP TABLE IF EXISTS test_plans;')
+    await adapter.execute(query='CREATE TABLE test_plans (id serial primary key, kind int);')
+    await adapter.insert_many(table='test_plans', rows=[{'kind': i % 50} for i in range(1000)])
+
+    await adapter.where('test_plans', kind=3)
+    await adapter.advisor.wait()
+    report = adapter.advisor.report()
+    assert report['shapes'][0]['captured'] == 1
+    assert report['seq_scans'] == {'test_plans': 1}
+    assert report['index_candidates'][0]['columns'] == ['kind']
+    await adapter.close()
+
+
+def test_pgbouncer_params():
+    adapter = DBAdapter(database='db', user='u', password='p', statement_timeout=2, pgbouncer=True,
+                        statements=['SELECT 1'], replicas=['replica1'])
+    assert adapter._params['statement_cache_size'] == 0
+    assert 'server_settings' not in adapter._params
+    assert adapter._timeout() == 2
+    assert adapter.replicas._params_list[0]['statement_cache_size'] == 0
+
+
+@pytest.mark.asyncio
+async def test_pgbouncer_mode():
+    settings = dict(get_db_settings())
+    settings['port'] = int(os.environ.get('PGBOUNCER_PORT', settings.get('port', 5432)))
+    adapter = DBAdapter(**settings, pgbouncer=True, max_size=2)
+    await adapter.execute(query='DROP TABLE IF EXISTS test_pooler;')
+    await adapter.execute(query='CREATE TABLE test_pooler (id serial primary key, name text);')
+    await adapter.insert(table='test_pooler', value_dict={'name': 'a'})
+
+    results = await asyncio.gather(*[adapter.where('test_pooler', name='a') for _ in range(20)])
+    assert all(len(rows) == 1 for rows in results)
+    async with adapter.acquire() as con:
+        assert await con.fetchval('SELECT count(*) FROM pg_prepared_statements') == 0
+    await adapter.close()
+
+
+@pytest.mark.asyncio
+async def test_delete_requires_conditions(pg):
+    for where_dict in (None, {}):
+        with pytest.raises(ValueError):
+            await pg.delete(table='test_table', where_dict=where_dict)
+
+
+def test_call_options():
+    assert _call_options(None, WHERE_OPTIONS) == {}
+    assert _call_options({'use_primary': True}, WHERE_OPTIONS) == {'use_primary': True}
+    with pytest.raises(TypeError):
+        _call_options({'use_primay': True}, WHERE_OPTIONS)
+
+
+@pytest.mark.asyncio
+async def test_option_named_columns(pg):
+    await pg.execute(query='DROP TABLE IF EXISTS test_options;')
+    await pg.execute(query='CREATE TABLE test_options (id serial primary key, priority int, timeout int);')
+    await pg.insert_many(table='test_options', rows=[(1, 10), (2, 20)], columns=['priority', 'timeout'])
+
+    rows = await pg.where('test_options', options={'use_primary': True}, priority=1)
+    assert [row['timeout'] for row in rows] == [10]
+    await pg.update(table='test_options', where_dict={'priority': 2}, timeout=30)
+    assert await pg.count('test_options', {'timeout': 30}, use_primary=True) == 1
+
+
+def test_batch_loader_cancel_one_caller():
+    class Adapter:
+        async def where(self, table, columns='*', options=None, **where_dict):
+            await asyncio.sleep(0.01)
+            return [{'id': key} for key in where_dict['id__in']]
+
+        def _map(self, rows):
+            return rows
+
+    async def run():
+        loader = BatchLoader(Adapter(), 'items')
+        first = asyncio.ensure_future(loader.load(1))
+        second = asyncio.ensure_future(loader.load(1))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second
+
+    assert asyncio.new_event_loop().run_until_complete(run()) == {'id': 1}
+
+
+def test_invalidation_waits_for_commit():
+    class Con:
+        in_transaction = True
+
+        def is_in_transaction(self):
+            return self.in_transaction
+
+    adapter = DBAdapter(result_cache={'default_ttl': 60})
+    con = Con()
+    generation = adapter.cache.generation('items')
+    adapter._invalidate(['items'], con)
+    assert adapter.cache.generation('items') == generation
+
+    con.in_transaction = False
+    adapter.flush_invalidations()
+    assert adapter.cache.generation('items') == generation + 1
+    assert not adapter._pending_invalidations
+
+
+def test_result_cache_schema_qualified_tables():
+    cache = ResultCache(table_ttls={'public.users': 60})
+    cache.set('users', 'q', [1], [{'id': 1}], cache.generation('users'))
+    assert cache.get('"Users"', 'q', [1]) == [{'id': 1}]
+    cache.invalidate(written_tables('UPDATE public."users" SET name = $1'))
+    assert cache.get('users', 'q', [1]) is MISS
+
+
+def test_replica_pool_single_flight(monkeypatch):
+    import trelliopg.pool
+    created = []
+
+    async def create_pool(**params):
+        created.append(params)
+        await asyncio.sleep(0.01)
+        return object()
+
+    monkeypatch.setattr(trelliopg.pool, 'create_pool', create_pool)
+    group = trelliopg.pool.PoolGroup([{'dsn': 'replica'}], health_check_interval=0)
+
+    async def run():
+        return await asyncio.gather(group._get(0), group._get(0), group._get(0))
+
+    pools = asyncio.new_event_loop().run_until_complete(run())
+    assert len(created) == 1 and len(set(map(id, pools))) == 1
+
+
+@pytest.mark.asyncio
+async def test_reads_on_transaction_connection(pg):
+    await pg.execute(query='DROP TABLE IF EXISTS test_read_con;')
+    await pg.execute(query='CREATE TABLE test_read_con (id serial primary key, name text);')
+
+    pool = await pg.get_pool()
+    async with pool.acquire() as con:
+        async with con.transaction():
+            await pg.insert(con, 'test_read_con', {'name': 'a'})
+            assert await pg.count('test_read_con', con=con) == 1
+            assert [row['name'] for row in await pg.where('test_read_con', options={'con': con}, name='a')] == ['a']
+    assert await pg.count('test_read_con', use_primary=True) == 1
+
+
+def test_buffered_writer_retry_and_failing_callback():
+    class Adapter:
+        attempts = 0
+
+        def acquire(self, **kwargs):
+            self.attempts += 1
+            raise OSError('down')
+
+    def on_error(table, rows, exc):
+        raise RuntimeError('callback failed')
+
+    adapter = Adapter()
+    writer = BufferedWriter(adapter, retries=2, retry_delay=0.001, on_error=on_error)
+
+    async def run():
+        writer.write('items', {'id': 1})
+        await writer.close()
+
+    asyncio.new_event_loop().run_until_complete(run())
+    assert adapter.attempts == 3
+    assert writer.failed == 1 and writer.callback_errors == 1
+
+
+@pytest.mark.asyncio
+async def test_search_index(pg):
+    await pg.execute(query='DROP TABLE IF EXISTS test_search_index;')
+    await pg.execute(query='CREATE TABLE test_search_index (id serial primary key, title text, body text);')
+
+    assert await pg.search_index('test_search_index', ['title', 'body']) == ['test_search_index_title_body_fts_idx']
+    assert await pg.search_index('test_search_index', ['title', 'body'], concurrently=False) == []
+
+    await pg.execute(query='CREATE SCHEMA IF NOT EXISTS test_other; DROP TABLE IF EXISTS test_other.test_search_index;'
+                           'CREATE TABLE test_other.test_search_index (id serial primary key, title text, body text);')
+    assert await pg.search_index('test_other.test_search_index', ['title', 'body']) == \
+        ['test_search_index_title_body_fts_idx']
+    await pg.execute(query='DROP SCHEMA test_other CASCADE;')
+
+
+def test_readonly_acquire_skips_dead_replica():
+    class Pool:
+        def __init__(self, name, alive=True):
+            self.name = name
+            self.alive = alive
+
+        def acquire(self, timeout=None):
+            pool = self
+
+            class Context:
+                async def __aenter__(self):
+                    if not pool.alive:
+                        raise ConnectionRefusedError(pool.name)
+                    return pool.name
+
+                async def __aexit__(self, *exc):
+                    pass
+
+            return Context()
+
+    adapter = DBAdapter(replicas=['replica1', 'replica2'])
+    adapter.pool = Pool('primary')
+    adapter.replicas.pools = [Pool('replica1', alive=False), Pool('replica2', alive=False)]
+
+    async def run():
+        async with adapter.acquire(readonly=True) as con:
+            return con
+
+    loop = asyncio.new_event_loop()
+    assert loop.run_until_complete(run()) == 'primary'
+    assert adapter.replicas._healthy() == []
+
+    adapter.replicas._down_until = [0, 0]
+    adapter.replicas.pools[1].alive = True
+    assert loop.run_until_complete(run()) == 'replica2'
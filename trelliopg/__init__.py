@@ -1,3 +1,8 @@
 from .sql import *
+from .shard import ShardedAdapter
 
-__all__ = ['DBAdapter', 'get_db_adapter', 'async_atomic', 'async_atomic_func', 'get_db_settings']
+__all__ = ['DBAdapter', 'get_db_adapter', 'async_atomic', 'async_atomic_func', 'get_db_settings', 'PoolGroup',
+           'ResultCache', 'BatchLoader', 'Metrics', 'RecordStream', 'PoolOverloadedError', 'PRIORITY_CRITICAL',
+           'PRIORITY_NORMAL', 'PRIORITY_BACKGROUND', 'ShardedAdapter', 'create_db_adapter', 'map_rows',
+           'register_json_codecs', 'BufferedWriter', 'WriterOverflowError', 'ChangeFeed', 'Subscription',
+           'ColumnBatch', 'ColumnStream', 'PlanAdvisor']
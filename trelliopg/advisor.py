@@ -0,0 +1,192 @@
+import asyncio
+import collections
+import json
+import random
+import re
+import time
+
+from .pool import PRIORITY_BACKGROUND
+
+# column compared in a plan filter or index condition, e.g. "(name ~~* '%a%'::text)" or "(id = ANY ($1))"
+FILTER_COLUMN = re.compile(r'\(+(?:\w+\.)?"?(\w+)"?(?:\)::\w+)?\s*(=|<>|<=|>=|<|>|~~\*?|!~~\*?|@@|%|IS)\s')
+RANGE_OPERATORS = ('<', '>', '<=', '>=')
+# operators a btree can not serve: (i)like and trigram similarity need a trigram gin, @@ a gin over the tsvector
+PATTERN_OPERATORS = {'~~': 'trigram', '~~*': 'trigram', '!~~': 'trigram', '!~~*': 'trigram', '%': 'trigram',
+                     '@@': 'fulltext'}
+BTREE = 'btree'
+
+
+def _walk(plan: dict):
+    yield plan
+    for child in plan.get('Plans', ()):
+        yield from _walk(child)
+
+
+def filter_columns(condition: str) -> list:
+    '''
+    columns of a plan filter a btree index can serve, equality comparisons first, then ranges
+    '''
+    order = {}
+    for column, operator in FILTER_COLUMN.findall(condition or ''):
+        if operator in ('=', 'IS'):
+            rank = 0
+        elif operator in RANGE_OPERATORS:
+            rank = 1
+        else:
+            continue
+        order[column] = min(rank, order.get(column, rank))
+    return sorted(order, key=lambda column: order[column])
+
+
+def pattern_columns(condition: str) -> dict:
+    '''
+    columns of a plan filter matched with pattern or text search operators, to trigram or fulltext
+    '''
+    return {column: PATTERN_OPERATORS[operator] for column, operator in FILTER_COLUMN.findall(condition or '')
+            if operator in PATTERN_OPERATORS}
+
+
+def index_ddl(table: str, columns: list, method: str = BTREE) -> str:
+    if method == 'trigram':
+        return 'CREATE INDEX ON {} USING gin ({});'.format(table, ', '.join(
+            '{} gin_trgm_ops'.format(column) for column in columns))
+    if method == 'fulltext':
+        return 'CREATE INDEX ON {} USING gin ({});'.format(table, ', '.join(columns))
+    return 'CREATE INDEX ON {} ({});'.format(table, ', '.join(columns))
+
+
+class QueryShape:
+    def __init__(self, method: str, table: str, query: str):
+        self.method = method
+        self.table = table
+        self.query = query
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.captured = 0
+        self.last_captured = 0
+        self.seq_scans = collections.Counter()
+        self.plan = None
+
+    def as_dict(self) -> dict:
+        return {'method': self.method, 'table': self.table, 'query': self.query, 'calls': self.calls,
+                'mean_ms': round(self.total / self.calls * 1000, 3) if self.calls else 0,
+                'max_ms': round(self.max * 1000, 3), 'captured': self.captured,
+                'seq_scans': dict(self.seq_scans), 'plan': self.plan}
+
+
+class PlanAdvisor:
+    '''
+    captures EXPLAIN (ANALYZE, BUFFERS) plans of the queries an adapter reads with, in the background.
+    a query is captured when it ran for at least threshold seconds or with probability sample_rate,
+    at most once per interval seconds per query shape and with at most max_pending explains running.
+
+    plans are aggregated per shape (the generated sql, arguments are always parameters), sequential scans
+    whose filter discarded at least min_rows_removed rows become index candidates for the filtered columns:
+    a btree over the equality and range columns, a gin per column matched with like, ilike, trigram % or @@.
+    the explained query is executed a second time, inside a transaction that is rolled back
+    '''
+
+    def __init__(self, adapter, threshold: float = None, sample_rate: float = 0.0, interval: float = 60,
+                 max_pending: int = 4, max_shapes: int = 1000, min_rows_removed: int = 1000):
+        self.adapter = adapter
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.max_pending = max_pending
+        self.max_shapes = max_shapes
+        self.min_rows_removed = min_rows_removed
+
+        self.shapes = collections.OrderedDict()
+        self.candidates = dict()
+        self.failures = 0
+        self._pending = set()
+
+    def observe(self, method: str, table: str, query: str, args, elapsed: float, use_primary: bool = False):
+        shape = self.shapes.get(query)
+        if shape is None:
+            if len(self.shapes) >= self.max_shapes:
+                self.shapes.popitem(last=False)
+            shape = self.shapes[query] = QueryShape(method, table, query)
+        shape.calls += 1
+        shape.total += elapsed
+        shape.max = max(shape.max, elapsed)
+
+        slow = self.threshold is not None and elapsed >= self.threshold
+        if not slow and not (self.sample_rate and random.random() < self.sample_rate):
+            return
+        now = time.monotonic()
+        if len(self._pending) >= self.max_pending or (shape.captured and now - shape.last_captured < self.interval):
+            return
+
+        shape.last_captured = now
+        task = asyncio.ensure_future(self.capture(shape, args, use_primary))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def capture(self, shape: QueryShape, args, use_primary: bool = False):
+        try:
+            async with self.adapter.acquire(readonly=not use_primary, priority=PRIORITY_BACKGROUND) as con:
+                transaction = con.transaction()
+                await transaction.start()
+                try:
+                    explained = await con.fetchval('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + shape.query, *args)
+                finally:
+                    await transaction.rollback()
+        except Exception:
+            self.failures += 1
+            return
+
+        plan = json.loads(explained) if isinstance(explained, str) else explained
+        shape.plan = plan[0]
+        shape.captured += 1
+        self._analyze(shape, plan[0]['Plan'])
+
+    def _analyze(self, shape: QueryShape, plan: dict):
+        for node in _walk(plan):
+            if node.get('Node Type') != 'Seq Scan':
+                continue
+            table = node.get('Relation Name', shape.table)
+            shape.seq_scans[table] += 1
+
+            removed = node.get('Rows Removed by Filter', 0) * node.get('Actual Loops', 1)
+            if removed < self.min_rows_removed:
+                continue
+            indexes = [(BTREE, tuple(filter_columns(node.get('Filter'))))]
+            indexes.extend((method, (column,)) for column, method in pattern_columns(node.get('Filter')).items())
+            for method, columns in indexes:
+                if not columns:
+                    continue
+                key = (table, columns, method)
+                candidate = self.candidates.get(key)
+                if candidate is None:
+                    candidate = self.candidates[key] = {'table': table, 'columns': list(columns), 'method': method,
+                                                        'scans': 0, 'rows_removed': 0, 'queries': set()}
+                candidate['scans'] += 1
+                candidate['rows_removed'] += removed
+                candidate['queries'].add(shape.query)
+
+    async def wait(self):
+        '''
+        waits for the explains in flight
+        '''
+        if self._pending:
+            await asyncio.wait(list(self._pending))
+
+    def report(self, limit: int = 20) -> dict:
+        '''
+        :return: slowest shapes by total time, sequential scans per table and index candidates by rows removed
+        '''
+        shapes = sorted(self.shapes.values(), key=lambda shape: shape.total, reverse=True)[:limit]
+        seq_scans = collections.Counter()
+        for shape in self.shapes.values():
+            seq_scans.update(shape.seq_scans)
+
+        candidates = []
+        for candidate in sorted(self.candidates.values(), key=lambda c: c['rows_removed'], reverse=True):
+            candidate = dict(candidate, queries=sorted(candidate['queries']))
+            candidate['ddl'] = index_ddl(candidate['table'], candidate['columns'], candidate['method'])
+            candidates.append(candidate)
+
+        return {'shapes': [shape.as_dict() for shape in shapes], 'seq_scans': dict(seq_scans),
+                'index_candidates': candidates, 'failures': self.failures}
@@ -0,0 +1,146 @@
+import collections
+import re
+import sys
+import time
+
+MISS = object()
+
+_WRITE_TABLES = re.compile(r'\b(?:insert\s+into|update|delete\s+from|truncate(?:\s+table)?|alter\s+table|'
+                           r'drop\s+table(?:\s+if\s+exists)?)\s+(?:only\s+)?([\w."]+)', re.IGNORECASE)
+_QUALIFIED = re.compile(r'^(?:"?\w+"?\.)?"?(\w+)"?$')
+
+
+def table_key(table: str) -> str:
+    '''
+    cache key of a table name: schema and quotes stripped and lower cased, so public.users, "users" and Users
+    share one key. anything else (a subquery) is used as is
+    '''
+    match = _QUALIFIED.match(table.strip())
+    return match.group(1).lower() if match else table
+
+
+def written_tables(query: str):
+    '''
+    :return: set of tables written by a raw query, or None when they can not be determined
+    '''
+    tables = set(match.strip('"') for match in _WRITE_TABLES.findall(query))
+    return tables or None
+
+
+def _hashable(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(_hashable(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _hashable(v)) for k, v in value.items()))
+    return value
+
+
+def _result_size(results) -> int:
+    size = sys.getsizeof(results)
+    for record in results:
+        size += sys.getsizeof(record)
+        for value in record.values():
+            size += sys.getsizeof(value)
+    return size
+
+
+class ResultCache:
+    '''
+    lru cache of read results keyed by compiled query and arguments.
+    tables are only cached when they have a ttl, either from table_ttls or default_ttl
+    '''
+
+    def __init__(self, max_entries: int = 1000, max_bytes: int = None, default_ttl: float = None,
+                 table_ttls: dict = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.table_ttls = {table_key(table): ttl for table, ttl in (table_ttls or {}).items()}
+
+        self._entries = collections.OrderedDict()
+        self._table_keys = collections.defaultdict(set)
+        self._generations = collections.defaultdict(int)
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def ttl(self, table: str):
+        return self.table_ttls.get(table_key(table), self.default_ttl)
+
+    def generation(self, table: str) -> int:
+        return self._generations[table_key(table)]
+
+    def get(self, table: str, query: str, args):
+        if self.ttl(table) is None:
+            return MISS
+
+        key = (query, _hashable(args))
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return MISS
+
+        expires, _, _, results = entry
+        if expires < time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return MISS
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return list(results)
+
+    def set(self, table: str, query: str, args, results, generation: int):
+        ttl = self.ttl(table)
+        table = table_key(table)
+        if ttl is None or generation != self._generations[table]:
+            return
+
+        key = (query, _hashable(args))
+        if key in self._entries:
+            self._remove(key)
+
+        size = _result_size(results) if self.max_bytes else 0
+        if self.max_bytes and size > self.max_bytes:
+            return
+
+        self._entries[key] = (time.monotonic() + ttl, size, table, list(results))
+        self._table_keys[table].add(key)
+        self.size += size
+
+        while len(self._entries) > self.max_entries or (self.max_bytes and self.size > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        _, size, table, _ = self._entries.pop(key)
+        self.size -= size
+        self._table_keys[table].discard(key)
+
+    def invalidate(self, tables=None):
+        '''
+        :param tables: iterable of table names, None clears every table
+        '''
+        if tables is None:
+            self._entries.clear()
+            self._table_keys.clear()
+            self.size = 0
+            for table in list(self._generations.keys()):
+                self._generations[table] += 1
+            self.invalidations += 1
+            return
+
+        for table in tables:
+            table = table_key(table)
+            self._generations[table] += 1
+            for key in self._table_keys.pop(table, ()):
+                _, size, _, _ = self._entries.pop(key)
+                self.size -= size
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        return {'entries': len(self._entries), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'invalidations': self.invalidations}
@@ -0,0 +1,97 @@
+import collections
+import functools
+import keyword
+
+try:
+    import orjson
+
+    def json_dumps(value) -> str:
+        return orjson.dumps(value).decode()
+
+    json_loads = orjson.loads
+except ImportError:
+    try:
+        import ujson as json
+    except ImportError:
+        import json
+
+    json_dumps = json.dumps
+    json_loads = json.loads
+
+SLOTS = 'slots'
+NAMEDTUPLE = 'namedtuple'
+TUPLE = 'tuple'
+
+
+def json_encode(value) -> str:
+    '''
+    str parameters are taken as json text that is already serialized, as without the codec,
+    so a bare json string has to be passed as json_dumps(value)
+    '''
+    if isinstance(value, str):
+        return value
+    return json_dumps(value)
+
+
+async def register_json_codecs(con):
+    '''
+    decodes json and jsonb columns to python objects with orjson or ujson when installed,
+    parameters other than str are encoded with the same library
+    '''
+    for type_name in ('json', 'jsonb'):
+        await con.set_type_codec(type_name, encoder=json_encode, decoder=json_loads, schema='pg_catalog')
+
+
+def _asdict(self) -> dict:
+    return dict(zip(self.__slots__, (getattr(self, name) for name in self.__slots__)))
+
+
+def _repr(self) -> str:
+    return '{}({})'.format(type(self).__name__, ', '.join(
+        '{}={!r}'.format(name, getattr(self, name)) for name in self.__slots__))
+
+
+@functools.lru_cache(maxsize=256)
+def row_class(columns: tuple, name: str = 'Row'):
+    '''
+    __slots__ class with one attribute per column, cached per column tuple
+    '''
+    args = ', '.join('_{}'.format(i) for i in range(len(columns)))
+    body = '\n'.join('    self.{} = _{}'.format(column, i) for i, column in enumerate(columns)) or '    pass'
+    namespace = {}
+    exec('def __init__(self, {}):\n{}'.format(args, body), namespace)
+    return type(name, (), {'__slots__': columns, '__init__': namespace['__init__'], '_asdict': _asdict,
+                           '__repr__': _repr})
+
+
+@functools.lru_cache(maxsize=256)
+def _namedtuple_class(columns: tuple, name: str = 'Row'):
+    return collections.namedtuple(name, columns, rename=True)
+
+
+def _identifiers(columns: tuple) -> bool:
+    if len(set(columns)) != len(columns):
+        return False
+    return all(column.isidentifier() and not keyword.iskeyword(column) and not column.startswith('_')
+               for column in columns)
+
+
+def map_rows(records: list, mapping=SLOTS) -> list:
+    '''
+    converts records without building a dict per row
+    :param mapping: slots, namedtuple, tuple or a class taking one positional argument per column
+    '''
+    if not records or not mapping:
+        return records
+    if mapping == TUPLE:
+        return [tuple(record) for record in records]
+
+    columns = tuple(records[0].keys())
+    if mapping == SLOTS and _identifiers(columns):
+        cls = row_class(columns)
+    elif mapping in (SLOTS, NAMEDTUPLE):
+        cls = _namedtuple_class(columns)
+        return [cls._make(record) for record in records]
+    else:
+        cls = mapping
+    return [cls(*record) for record in records]
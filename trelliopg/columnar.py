@@ -0,0 +1,400 @@
+import asyncio
+import datetime
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+PG_EPOCH_US = 946684800000000
+PG_EPOCH_DAYS = 10957
+DATETIME64_MAX = 2 ** 63 - 1
+DATETIME64_MIN = -2 ** 63 + 1
+
+# binary COPY layout of fixed width types: (big endian wire dtype, numpy dtype of the column)
+FIXED_TYPES = {
+    'int2': ('>i2', 'int16'),
+    'int4': ('>i4', 'int32'),
+    'int8': ('>i8', 'int64'),
+    'float4': ('>f4', 'float32'),
+    'float8': ('>f8', 'float64'),
+    'bool': ('u1', 'bool'),
+    'timestamp': ('>i8', 'datetime64[us]'),
+    'timestamptz': ('>i8', 'datetime64[us]'),
+    'date': ('>i4', 'datetime64[D]'),
+}
+
+_EMPTY = {'int16': 0, 'int32': 0, 'int64': 0, 'float32': 0, 'float64': 0, 'bool': False}
+
+_DONE = object()
+
+
+def _require_numpy():
+    if numpy is None:
+        raise ImportError('columnar fetches need numpy, pip install numpy')
+
+
+class ColumnBatch:
+    '''
+    one numpy array per column plus a boolean null mask (True where null) for columns holding nulls.
+    null slots of numeric columns hold 0, of timestamp columns NaT and of object columns None.
+    infinity and -infinity timestamps and dates decoded from binary COPY are the latest and earliest datetime64
+    '''
+
+    def __init__(self, names: list, arrays: list, masks: list):
+        self.names = list(names)
+        self.columns = dict(zip(self.names, arrays))
+        self.masks = {name: mask for name, mask in zip(self.names, masks) if mask is not None and mask.any()}
+
+    def __len__(self):
+        return len(self.columns[self.names[0]]) if self.names else 0
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def mask(self, name):
+        '''
+        :return: null mask of column, None when it has no nulls
+        '''
+        return self.masks.get(name)
+
+    def masked(self, name):
+        '''
+        :return: column as numpy.ma.MaskedArray
+        '''
+        return numpy.ma.MaskedArray(self.columns[name], mask=self.masks.get(name, False))
+
+    @classmethod
+    def concat(cls, batches: list, names: list = None):
+        batches = [batch for batch in batches if len(batch)]
+        if not batches:
+            return cls(names or [], [numpy.array([]) for _ in names or []], [None for _ in names or []])
+        names = batches[0].names
+        arrays = [numpy.concatenate([batch.columns[name] for batch in batches]) for name in names]
+        masks = []
+        for name in names:
+            if any(name in batch.masks for batch in batches):
+                masks.append(numpy.concatenate([batch.masks.get(name, numpy.zeros(len(batch), bool))
+                                                for batch in batches]))
+            else:
+                masks.append(None)
+        return cls(names, arrays, masks)
+
+
+def _convert(values, dtype: str):
+    if dtype.startswith('datetime64'):
+        # infinity and -infinity are the largest and smallest wire values, shifting them by the epoch would
+        # overflow: they become the latest and earliest datetime64 (the smallest int64 is NaT)
+        bounds = numpy.iinfo(values.dtype)
+        values = values.astype('int64')
+        shifted = numpy.where((values == bounds.max) | (values == bounds.min), 0,
+                              values + (PG_EPOCH_US if dtype == 'datetime64[us]' else PG_EPOCH_DAYS))
+        shifted[values == bounds.max] = DATETIME64_MAX
+        shifted[values == bounds.min] = DATETIME64_MIN
+        return shifted.astype(dtype)
+    return values.astype(dtype)
+
+
+class BinaryCopyParser:
+    '''
+    decodes a binary COPY stream of fixed width columns into arrays.
+    runs of rows without nulls have a constant stride and are decoded with one numpy.frombuffer call,
+    chunks containing nulls fall back to walking the rows
+    '''
+
+    def __init__(self, names: list, types: list):
+        _require_numpy()
+        self.names = names
+        self.wire = [numpy.dtype(FIXED_TYPES[type_name][0]) for type_name in types]
+        self.dtypes = [FIXED_TYPES[type_name][1] for type_name in types]
+        fields = [('count', '>i2')]
+        for i, wire in enumerate(self.wire):
+            fields.extend([('length{}'.format(i), '>i4'), ('value{}'.format(i), wire)])
+        self.row_dtype = numpy.dtype(fields)
+        self.row_size = self.row_dtype.itemsize
+
+        self._buffer = bytearray()
+        self._header = False
+        self.finished = False
+
+    def feed(self, data: bytes) -> list:
+        '''
+        :return: list of (arrays, masks) for the complete rows received so far
+        '''
+        self._buffer.extend(data)
+        if not self._header:
+            if len(self._buffer) < 19:
+                return []
+            if bytes(self._buffer[:11]) != COPY_SIGNATURE:
+                raise ValueError('not a binary COPY stream')
+            extension, = struct.unpack_from('>i', self._buffer, 15)
+            del self._buffer[:19 + extension]
+            self._header = True
+
+        chunks = []
+        while self._buffer and not self.finished:
+            parsed, consumed = self._parse_fixed()
+            if not consumed:
+                parsed, consumed = self._parse_rows()
+            if not consumed:
+                break
+            del self._buffer[:consumed]
+            if parsed is not None:
+                chunks.append(parsed)
+        return chunks
+
+    def _parse_fixed(self):
+        count = len(self._buffer) // self.row_size
+        if not count:
+            return None, 0
+        rows = numpy.frombuffer(bytes(self._buffer[:count * self.row_size]), dtype=self.row_dtype)
+        valid = rows['count'] == len(self.wire)
+        for i, wire in enumerate(self.wire):
+            valid &= rows['length{}'.format(i)] == wire.itemsize
+        if not valid.all():
+            count = int(valid.argmin())
+            if not count:
+                return None, 0
+            rows = rows[:count]
+        arrays = [_convert(rows['value{}'.format(i)], dtype) for i, dtype in enumerate(self.dtypes)]
+        return (arrays, [None] * len(arrays)), count * self.row_size
+
+    def _read_row(self, offset: int) -> tuple:
+        '''
+        :return: (list of raw values with None for nulls, offset of the next row),
+        (None, offset) when the row is incomplete and (_DONE, offset) at the trailer
+        '''
+        buffer = self._buffer
+        if offset + 2 > len(buffer):
+            return None, offset
+        if struct.unpack_from('>h', buffer, offset)[0] == -1:
+            return _DONE, offset + 2
+
+        position = offset + 2
+        row = []
+        for _ in self.wire:
+            if position + 4 > len(buffer):
+                return None, offset
+            length, = struct.unpack_from('>i', buffer, position)
+            position += 4
+            if length == -1:
+                row.append(None)
+                continue
+            if position + length > len(buffer):
+                return None, offset
+            row.append(bytes(buffer[position:position + length]))
+            position += length
+        return row, position
+
+    def _parse_rows(self, resume_after: int = 64):
+        '''
+        walks rows one by one until resume_after rows in a row had no nulls, the fixed stride path takes over then
+        '''
+        offset = 0
+        clean = 0
+        columns = [[] for _ in self.wire]
+        nulls = [[] for _ in self.wire]
+        while clean < resume_after:
+            row, position = self._read_row(offset)
+            offset = position
+            if row is _DONE:
+                self.finished = True
+                break
+            if row is None:
+                break
+
+            for i, value in enumerate(row):
+                columns[i].append(value if value is not None else b'\x00' * self.wire[i].itemsize)
+                nulls[i].append(value is None)
+            clean = 0 if None in row else clean + 1
+
+        if not columns or not columns[0]:
+            return None, offset
+        arrays = []
+        masks = []
+        for i, dtype in enumerate(self.dtypes):
+            values = _convert(numpy.frombuffer(b''.join(columns[i]), dtype=self.wire[i]), dtype)
+            mask = numpy.array(nulls[i], dtype=bool)
+            if mask.any():
+                values[mask] = numpy.datetime64('NaT') if dtype.startswith('datetime64') else _EMPTY[dtype]
+            arrays.append(values)
+            masks.append(mask)
+        return (arrays, masks), offset
+
+
+def records_to_columns(records: list, types: list) -> tuple:
+    '''
+    column arrays and null masks of a list of records, for result sets with types binary COPY can not decode
+    '''
+    arrays = []
+    masks = []
+    for i, type_name in enumerate(types):
+        values = [record[i] for record in records]
+        mask = numpy.fromiter((value is None for value in values), dtype=bool, count=len(values))
+        dtype = FIXED_TYPES[type_name][1] if type_name in FIXED_TYPES else None
+        if dtype is None:
+            array = numpy.empty(len(values), dtype=object)
+            array[:] = values
+        elif dtype.startswith('datetime64'):
+            if type_name == 'timestamptz':
+                values = [value.astimezone(datetime.timezone.utc).replace(tzinfo=None) if value is not None
+                          else None for value in values]
+            array = numpy.array([value if value is not None else 'NaT' for value in values], dtype=dtype)
+        else:
+            empty = _EMPTY[dtype]
+            array = numpy.fromiter((empty if value is None else value for value in values), dtype=dtype,
+                                   count=len(values))
+        arrays.append(array)
+        masks.append(mask)
+    return arrays, masks
+
+
+class ColumnStream:
+    '''
+    async iterator of ColumnBatch of up to batch_size rows.
+    result sets made only of FIXED_TYPES columns are read with binary COPY, others through a cursor.
+    a background task reads ahead inside a transaction and holds its connection until the stream is exhausted
+    or closed, use it as an async context manager when breaking out early
+    '''
+
+    def __init__(self, adapter, table: str, query: str, args=(), batch_size: int = 100000,
+                 use_primary: bool = False):
+        _require_numpy()
+        self.adapter = adapter
+        self.table = table
+        self.query = query
+        self.args = args
+        self.batch_size = batch_size
+        self.use_primary = use_primary
+
+        self.names = None
+        self.types = None
+        self.copy = None
+        self.rows = 0
+        self._queue = asyncio.Queue(maxsize=2)
+        self._task = None
+        self._closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def __anext__(self):
+        if self._task is None:
+            if self._closed:
+                raise StopAsyncIteration
+            self._task = asyncio.ensure_future(self._produce())
+        item = await self._queue.get()
+        if item is _DONE:
+            self._queue.put_nowait(_DONE)
+            raise StopAsyncIteration
+        if isinstance(item, BaseException):
+            self._queue.put_nowait(_DONE)
+            raise item
+        return item
+
+    async def _emit(self, arrays: list, masks: list):
+        self.rows += len(arrays[0]) if arrays else 0
+        await self._queue.put(ColumnBatch(self.names, arrays, masks))
+
+    async def _produce(self):
+        try:
+            async with self.adapter.acquire(readonly=not self.use_primary) as con:
+                with self.adapter._timed('columns', self.table, self.query) as timed:
+                    # one transaction keeps the prepared statement and the read on the same server connection
+                    # behind transaction poolers
+                    async with con.transaction():
+                        statement = await con.prepare(self.query)
+                        attributes = statement.get_attributes()
+                        self.names = [attribute.name for attribute in attributes]
+                        self.types = [attribute.type.name for attribute in attributes]
+                        self.copy = all(type_name in FIXED_TYPES for type_name in self.types)
+                        if self.copy:
+                            await self._copy(con)
+                        else:
+                            await self._cursor(con)
+                    timed.rows = self.rows
+            await self._queue.put(_DONE)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await self._queue.put(e)
+
+    async def _copy(self, con):
+        parser = BinaryCopyParser(self.names, self.types)
+        pending = []
+
+        async def flush(final=False):
+            while pending and (final or sum(len(arrays[0]) for arrays, _ in pending) >= self.batch_size):
+                arrays, masks = self._combine(pending)
+                del pending[:]
+                if not final and len(arrays[0]) > self.batch_size:
+                    pending.append(([array[self.batch_size:] for array in arrays],
+                                    [mask[self.batch_size:] if mask is not None else None for mask in masks]))
+                    arrays = [array[:self.batch_size] for array in arrays]
+                    masks = [mask[:self.batch_size] if mask is not None else None for mask in masks]
+                await self._emit(arrays, masks)
+
+        async def output(data):
+            pending.extend(parser.feed(data))
+            await flush()
+
+        await con.copy_from_query(self.query, *self.args, output=output, format='binary')
+        await flush(final=True)
+
+    @staticmethod
+    def _combine(chunks: list) -> tuple:
+        if len(chunks) == 1:
+            return chunks[0]
+        arrays = [numpy.concatenate([chunk[0][i] for chunk in chunks]) for i in range(len(chunks[0][0]))]
+        masks = []
+        for i in range(len(arrays)):
+            if any(chunk[1][i] is not None for chunk in chunks):
+                masks.append(numpy.concatenate([chunk[1][i] if chunk[1][i] is not None else
+                                                numpy.zeros(len(chunk[0][i]), bool) for chunk in chunks]))
+            else:
+                masks.append(None)
+        return arrays, masks
+
+    async def _cursor(self, con):
+        cursor = await con.cursor(self.query, *self.args)
+        while True:
+            records = await cursor.fetch(self.batch_size)
+            if records:
+                await self._emit(*records_to_columns(records, self.types))
+            if len(records) < self.batch_size:
+                break
+
+    async def fetch(self) -> ColumnBatch:
+        '''
+        reads the remaining rows into one ColumnBatch
+        '''
+        batches = []
+        while True:
+            try:
+                batches.append(await self.__anext__())
+            except StopAsyncIteration:
+                break
+        return ColumnBatch.concat(batches, self.names)
+
+    async def close(self):
+        self._closed = True
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        self._queue.put_nowait(_DONE)
@@ -0,0 +1,83 @@
+import asyncio
+
+
+class BatchLoader:
+    '''
+    coalesces concurrent single key lookups on a table into one "key = any($1)" query.
+    keys requested within the same loop iteration (or window seconds) are fetched together,
+    a batch is sent early once it reaches max_batch_size
+    '''
+
+    def __init__(self, adapter, table: str, key: str = 'id', columns='*', max_batch_size: int = 500,
+                 window: float = 0, use_primary: bool = False):
+        if isinstance(columns, list):
+            if key not in columns:
+                columns = columns + [key]
+            columns = ','.join(columns)
+
+        self.adapter = adapter
+        self.table = table
+        self.key = key
+        self.columns = columns
+        self.max_batch_size = max_batch_size
+        self.window = window
+        self.use_primary = use_primary
+
+        self._pending = {}
+        self._inflight = {}
+        self._handle = None
+
+    def load(self, key):
+        '''
+        :return: awaitable resolving to the row for key, or None when it does not exist.
+        every caller gets its own shielded awaitable, cancelling it leaves the lookup running for the others
+        '''
+        future = self._pending.get(key) or self._inflight.get(key)
+        if future is not None:
+            return asyncio.shield(future)
+
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._pending[key] = future
+
+        if len(self._pending) >= self.max_batch_size:
+            self._dispatch()
+        elif self._handle is None:
+            if self.window:
+                self._handle = loop.call_later(self.window, self._dispatch)
+            else:
+                self._handle = loop.call_soon(self._dispatch)
+        return asyncio.shield(future)
+
+    async def load_many(self, keys) -> list:
+        return list(await asyncio.gather(*[self.load(key) for key in keys]))
+
+    def _dispatch(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+        batch, self._pending = self._pending, {}
+        if batch:
+            self._inflight.update(batch)
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch: dict):
+        try:
+            where_dict = {self.key + '__in': list(batch.keys())}
+            rows = await self.adapter.where(self.table, columns=self.columns,
+                                            options={'use_primary': self.use_primary, 'mapping': False},
+                                            **where_dict)
+        except Exception as e:
+            for key, future in batch.items():
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            mapped = self.adapter._map(rows)
+            found = {row[self.key]: mapped_row for row, mapped_row in zip(rows, mapped)}
+            for key, future in batch.items():
+                if not future.done():
+                    future.set_result(found.get(key))
+        finally:
+            for key in batch:
+                self._inflight.pop(key, None)
@@ -0,0 +1,137 @@
+import bisect
+import collections
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _label(value) -> str:
+    '''
+    label value escaped for the text exposition format, tables can be subqueries holding quotes and newlines
+    '''
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+
+class Metrics:
+    '''
+    default DBAdapter instrumentation, any object with the same acquire and query methods can be used instead.
+
+    acquire(wait) is called with the seconds spent waiting for a pool connection,
+    query(method, table, query, elapsed, rows, error=None) after every statement the adapter runs, elapsed
+    excludes the acquire wait and error is the class name of the exception a failed statement raised.
+    on_slow_query(method, table, query, elapsed) is called for statements slower than slow_query_threshold seconds,
+    exceptions it raises are logged and counted in callback_errors
+    '''
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, slow_query_threshold: float = None, on_slow_query=None):
+        self.buckets = buckets
+        self.slow_query_threshold = slow_query_threshold
+        self.on_slow_query = on_slow_query
+
+        self.acquire_wait = Histogram(buckets)
+        self.latency = collections.defaultdict(lambda: Histogram(self.buckets))
+        self.rows = collections.Counter()
+        self.errors = collections.Counter()
+        self.slow_queries = 0
+        self.callback_errors = 0
+        self.pool_stats = None
+        self.writer = None
+
+    def acquire(self, wait: float):
+        self.acquire_wait.observe(wait)
+
+    def query(self, method: str, table: str, query: str, elapsed: float, rows: int = 0, error: str = None):
+        self.latency[(method, table)].observe(elapsed)
+        if rows:
+            self.rows[(method, table)] += rows
+        if error is not None:
+            self.errors[(method, table, error)] += 1
+
+        if self.slow_query_threshold is not None and elapsed >= self.slow_query_threshold:
+            self.slow_queries += 1
+            if self.on_slow_query is not None:
+                try:
+                    self.on_slow_query(method, table, query, elapsed)
+                except Exception:
+                    self.callback_errors += 1
+                    logger.exception('on_slow_query failed for %s on %s', method, table)
+
+    def to_prometheus(self, prefix: str = 'trelliopg') -> str:
+        lines = []
+
+        def histogram(name, hist, labels=''):
+            for bound, count in hist.cumulative():
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, labels, le, count))
+            braces = '{' + labels.rstrip(',') + '}' if labels else ''
+            lines.append('{}_sum{} {}'.format(name, braces, hist.sum))
+            lines.append('{}_count{} {}'.format(name, braces, hist.count))
+
+        name = prefix + '_pool_acquire_seconds'
+        lines.append('# TYPE {} histogram'.format(name))
+        histogram(name, self.acquire_wait)
+
+        name = prefix + '_query_seconds'
+        lines.append('# TYPE {} histogram'.format(name))
+        for (method, table), hist in sorted(self.latency.items()):
+            histogram(name, hist, 'method="{}",table="{}",'.format(_label(method), _label(table)))
+
+        name = prefix + '_rows_total'
+        lines.append('# TYPE {} counter'.format(name))
+        for (method, table), rows in sorted(self.rows.items()):
+            lines.append('{}{{method="{}",table="{}"}} {}'.format(name, _label(method), _label(table), rows))
+
+        name = prefix + '_query_errors_total'
+        lines.append('# TYPE {} counter'.format(name))
+        for (method, table, error), count in sorted(self.errors.items()):
+            lines.append('{}{{method="{}",table="{}",error="{}"}} {}'.format(name, _label(method), _label(table),
+                                                                          _label(error), count))
+
+        name = prefix + '_slow_queries_total'
+        lines.append('# TYPE {} counter'.format(name))
+        lines.append('{} {}'.format(name, self.slow_queries))
+
+        if self.pool_stats is not None:
+            for gauge in ('size', 'idle', 'in_use', 'max_size'):
+                name = '{}_pool_{}'.format(prefix, gauge)
+                lines.append('# TYPE {} gauge'.format(name))
+                for stats in self.pool_stats():
+                    lines.append('{}{{pool="{}"}} {}'.format(name, _label(stats['pool']), stats[gauge]))
+
+        if self.writer is not None:
+            name = prefix + '_writer_queue_depth'
+            lines.append('# TYPE {} gauge'.format(name))
+            for table, depth in sorted(self.writer.queue_depth().items()):
+                lines.append('{}{{table="{}"}} {}'.format(name, _label(table), depth))
+
+            for counter in ('written', 'dropped', 'failed', 'callback_errors'):
+                name = '{}_writer_{}_total'.format(prefix, counter)
+                lines.append('# TYPE {} counter'.format(name))
+                lines.append('{} {}'.format(name, getattr(self.writer, counter)))
+
+            name = prefix + '_writer_flush_seconds'
+            lines.append('# TYPE {} histogram'.format(name))
+            histogram(name, self.writer.flush_latency)
+
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,236 @@
+import asyncio
+import re
+
+from asyncpg import connect
+
+POOL_PARAMS = ('min_size', 'max_size', 'max_queries', 'max_inactive_connection_lifetime', 'setup', 'init', 'reset')
+
+_CLOSED = object()
+
+
+def _channel_name(table: str) -> str:
+    return '{}_changes'.format(re.sub(r'\W', '_', table))
+
+
+def notify_trigger_ddl(table: str, channel: str = None, columns: list = None) -> str:
+    '''
+    trigger function and row trigger publishing every insert, update and delete on table to channel as
+    {"table": ..., "op": "INSERT" | "UPDATE" | "DELETE", "row": {...}}.
+    notify payloads are limited to 8000 bytes, pass columns (e.g. the primary key) for wide tables
+    '''
+    channel = channel or _channel_name(table)
+    if not re.match(r'^\w+$', channel):
+        raise ValueError('invalid channel name "{}"'.format(channel))
+
+    name = re.sub(r'\W', '_', table)
+    if columns:
+        row = 'json_build_object({})'.format(', '.join("'{0}', r.{0}".format(column) for column in columns))
+    else:
+        row = 'row_to_json(r)'
+    return '''CREATE OR REPLACE FUNCTION trelliopg_notify_{name}() RETURNS trigger AS $$
+DECLARE
+    r record;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        r := OLD;
+    ELSE
+        r := NEW;
+    END IF;
+    PERFORM pg_notify('{channel}', json_build_object('table', TG_TABLE_NAME, 'op', TG_OP, 'row', {row})::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS trelliopg_notify_{name} ON {table};
+CREATE TRIGGER trelliopg_notify_{name} AFTER INSERT OR UPDATE OR DELETE ON {table}
+    FOR EACH ROW EXECUTE PROCEDURE trelliopg_notify_{name}();'''.format(name=name, table=table, channel=channel,
+                                                                          row=row)
+
+
+def drop_notify_trigger_ddl(table: str) -> str:
+    name = re.sub(r'\W', '_', table)
+    return 'DROP TRIGGER IF EXISTS trelliopg_notify_{0} ON {1};' \
+           'DROP FUNCTION IF EXISTS trelliopg_notify_{0}();'.format(name, table)
+
+
+class Subscription:
+    '''
+    bounded queue of payloads of one channel, iterate over it or await get().
+    when the consumer falls behind by queue_size payloads the oldest ones are dropped and counted in dropped
+    '''
+
+    def __init__(self, feed, channel: str, queue_size: int, decode=None):
+        self.feed = feed
+        self.channel = channel
+        self.decode = decode
+        self.dropped = 0
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._closed = False
+
+    def _put(self, payload):
+        if self._queue.full():
+            self._queue.get_nowait()
+            self.dropped += 1
+        self._queue.put_nowait(payload)
+
+    async def get(self):
+        payload = await self._queue.get()
+        if payload is _CLOSED:
+            self._queue.put_nowait(_CLOSED)
+            raise StopAsyncIteration
+        return self.decode(payload) if self.decode else payload
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.get()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def close(self):
+        if not self._closed:
+            self._closed = True
+            await self.feed._unsubscribe(self)
+            while not self._queue.empty():
+                self._queue.get_nowait()
+            self._queue.put_nowait(_CLOSED)
+
+
+class ChangeFeed:
+    '''
+    LISTEN on one dedicated connection outside the pool, fanning notifications out to any number of
+    subscriptions. the connection is health checked every health_check_interval seconds and reopened
+    after reconnect_interval seconds when lost, every channel is listened to again and on_reconnect() is called.
+    notifications sent while disconnected are lost.
+    LISTEN needs a session, behind a transaction pooler pass the dsn of the database itself
+    '''
+
+    def __init__(self, params: dict, queue_size: int = 1000, reconnect_interval: float = 1.0,
+                 health_check_interval: float = 10, connect_timeout: float = 10, on_reconnect=None,
+                 dsn: str = None):
+        self._params = {key: value for key, value in params.items() if key not in POOL_PARAMS}
+        if dsn:
+            self._params['dsn'] = dsn
+        self.queue_size = queue_size
+        self.reconnect_interval = reconnect_interval
+        self.health_check_interval = health_check_interval
+        self.connect_timeout = connect_timeout
+        self.on_reconnect = on_reconnect
+
+        self.connects = 0
+        self._channels = dict()
+        self._con = None
+        self._task = None
+        self._ready = None
+        self._stop = None
+        self._closed = False
+
+    async def subscribe(self, channel: str, queue_size: int = None, decode=None) -> Subscription:
+        '''
+        :param decode: applied to every payload, e.g. json.loads for notify_trigger payloads
+        '''
+        if self._closed:
+            raise RuntimeError('change feed is closed')
+
+        subscription = Subscription(self, channel, queue_size or self.queue_size, decode)
+        subscribers = self._channels.get(channel)
+        if subscribers is None:
+            subscribers = self._channels[channel] = set()
+            if self._con is not None:
+                try:
+                    await self._con.add_listener(channel, self._dispatch)
+                except Exception:
+                    self._stop.set()
+        subscribers.add(subscription)
+
+        if self._task is None:
+            self._ready = asyncio.Event()
+            self._stop = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+        try:
+            await asyncio.wait_for(self._ready.wait(), self.connect_timeout)
+        except asyncio.TimeoutError:
+            await self._unsubscribe(subscription)
+            raise
+        return subscription
+
+    async def _unsubscribe(self, subscription: Subscription):
+        subscribers = self._channels.get(subscription.channel)
+        if subscribers is None:
+            return
+        subscribers.discard(subscription)
+        if not subscribers:
+            del self._channels[subscription.channel]
+            if self._con is not None:
+                try:
+                    await self._con.remove_listener(subscription.channel, self._dispatch)
+                except Exception:
+                    self._stop.set()
+
+    def _dispatch(self, con, pid, channel, payload):
+        for subscription in list(self._channels.get(channel, ())):
+            subscription._put(payload)
+
+    async def _run(self):
+        while not self._closed:
+            try:
+                con = await connect(**self._params)
+            except Exception:
+                await self._sleep(self.reconnect_interval)
+                continue
+
+            try:
+                listening = set()
+                while set(self._channels) - listening:
+                    for channel in set(self._channels) - listening:
+                        await con.add_listener(channel, self._dispatch)
+                        listening.add(channel)
+
+                self._con = con
+                self._ready.set()
+                self.connects += 1
+                if self.connects > 1 and self.on_reconnect is not None:
+                    self.on_reconnect()
+
+                while not self._closed and not con.is_closed():
+                    if await self._sleep(self.health_check_interval):
+                        break
+                    await con.fetchval('SELECT 1', timeout=self.health_check_interval)
+            except Exception:
+                pass
+            finally:
+                self._con = None
+                self._ready.clear()
+                if self._closed:
+                    await con.close()
+                else:
+                    con.terminate()
+
+            if not self._closed:
+                await self._sleep(self.reconnect_interval)
+
+    async def _sleep(self, seconds: float) -> bool:
+        '''
+        :return: True when woken early by close or a failed listen
+        '''
+        try:
+            await asyncio.wait_for(self._stop.wait(), seconds)
+        except asyncio.TimeoutError:
+            return False
+        if not self._closed:
+            self._stop.clear()
+        return True
+
+    async def close(self):
+        self._closed = True
+        for subscribers in list(self._channels.values()):
+            for subscription in list(subscribers):
+                await subscription.close()
+        if self._task is not None:
+            self._stop.set()
+            await self._task
+            self._task = None
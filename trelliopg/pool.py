@@ -0,0 +1,201 @@
+import asyncio
+import functools
+import heapq
+import itertools
+import time
+
+from asyncpg.exceptions import CannotConnectNowError, PostgresConnectionError
+from asyncpg.pool import Pool, create_pool
+
+ROUND_ROBIN = 'round_robin'
+LEAST_BUSY = 'least_busy'
+
+PRIORITY_CRITICAL = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BACKGROUND = 2
+
+# a server that is gone, refusing connections or shutting down, as opposed to a busy one
+CONNECTION_ERRORS = (OSError, PostgresConnectionError, CannotConnectNowError)
+
+
+class PoolOverloadedError(Exception):
+    pass
+
+
+class Admission:
+    '''
+    bounded, priority ordered queue in front of a pool.
+    at most capacity callers hold a connection, at most max_waiters wait for one and further callers are
+    rejected with PoolOverloadedError, except critical ones which are always queued and served first
+    '''
+
+    def __init__(self, capacity: int, max_waiters: int = None):
+        self.capacity = capacity
+        self.max_waiters = max_waiters
+        self.in_use = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._waiters = []
+        self._counter = itertools.count()
+
+    async def acquire(self, priority: int = PRIORITY_NORMAL, timeout: float = None):
+        if self.in_use < self.capacity and not self.waiting:
+            self.in_use += 1
+            return
+
+        if priority > PRIORITY_CRITICAL and self.max_waiters is not None and self.waiting >= self.max_waiters:
+            self.rejected += 1
+            raise PoolOverloadedError('{} callers already waiting for a connection'.format(self.waiting))
+
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(future, timeout)
+        except BaseException:
+            if future.done() and not future.cancelled():
+                self.release()
+            else:
+                future.cancel()
+            raise
+        finally:
+            self.waiting -= 1
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.in_use -= 1
+
+
+class PoolGroup:
+    '''
+    a set of equivalent pools (read replicas), one is picked per acquire.
+    replicas failing to connect or to answer a health check are skipped for retry_interval seconds
+    '''
+
+    def __init__(self, params_list: list, selection: str = ROUND_ROBIN, retry_interval: float = 30,
+                 health_check_interval: float = 10, health_check_timeout: float = 2):
+        if selection not in (ROUND_ROBIN, LEAST_BUSY):
+            raise ValueError('unknown replica selection "{}"'.format(selection))
+
+        self._params_list = params_list
+        self.selection = selection
+        self.retry_interval = retry_interval
+        self.health_check_interval = health_check_interval
+        self.health_check_timeout = health_check_timeout
+
+        self.pools = [None] * len(params_list)
+        self._creations = [None] * len(params_list)
+        self._down_until = [0] * len(params_list)
+        self._counter = itertools.count()
+        self._last_health_check = time.monotonic()
+        self._health_check = None
+
+    def __len__(self):
+        return len(self._params_list)
+
+    def _healthy(self):
+        now = time.monotonic()
+        return [i for i in range(len(self._params_list)) if self._down_until[i] <= now]
+
+    def _order(self, candidates):
+        if self.selection == LEAST_BUSY:
+            def busy(i):
+                pool = self.pools[i]
+                if pool is None:
+                    return 0
+                return pool.get_size() - pool.get_idle_size()
+
+            return sorted(candidates, key=busy)
+
+        start = next(self._counter)
+        return [candidates[(start + i) % len(candidates)] for i in range(len(candidates))]
+
+    def mark_down(self, index: int):
+        self._down_until[index] = time.monotonic() + self.retry_interval
+
+    def mark_pool_down(self, pool: Pool) -> bool:
+        '''
+        :return: False when pool is not one of the replica pools
+        '''
+        for index, replica in enumerate(self.pools):
+            if replica is pool:
+                self.mark_down(index)
+                return True
+        return False
+
+    async def _get(self, index: int) -> Pool:
+        if self.pools[index] is None:
+            # single flight, concurrent callers wait on the same pool creation
+            if self._creations[index] is None:
+                creation = self._creations[index] = asyncio.ensure_future(create_pool(**self._params_list[index]))
+                creation.add_done_callback(functools.partial(self._created, index))
+            await asyncio.shield(self._creations[index])
+        return self.pools[index]
+
+    def _created(self, index: int, creation: asyncio.Future):
+        self._creations[index] = None
+        if not creation.cancelled() and creation.exception() is None:
+            self.pools[index] = creation.result()
+
+    async def get_pool(self) -> Pool:
+        '''
+        :return: a healthy replica pool, or None when no replica is reachable
+        '''
+        if self.health_check_interval and self._health_check is None and \
+                time.monotonic() - self._last_health_check > self.health_check_interval:
+            self._health_check = asyncio.ensure_future(self.check_health())
+
+        candidates = self._healthy()
+        if not candidates:
+            return None
+
+        for index in self._order(candidates):
+            try:
+                return await self._get(index)
+            except (OSError, asyncio.TimeoutError):
+                self.mark_down(index)
+        return None
+
+    async def open(self) -> list:
+        '''
+        creates every reachable replica pool
+        :return: list of opened pools
+        '''
+        pools = []
+        for index in range(len(self._params_list)):
+            try:
+                pools.append(await self._get(index))
+            except (OSError, asyncio.TimeoutError):
+                self.mark_down(index)
+        return pools
+
+    async def check_health(self):
+        try:
+            for index, pool in enumerate(self.pools):
+                if pool is None:
+                    continue
+                try:
+                    await pool.fetchval('SELECT 1', timeout=self.health_check_timeout)
+                    self._down_until[index] = 0
+                except Exception:
+                    self.mark_down(index)
+        finally:
+            self._last_health_check = time.monotonic()
+            self._health_check = None
+
+    async def close(self):
+        if self._health_check is not None:
+            self._health_check.cancel()
+            try:
+                await self._health_check
+            except asyncio.CancelledError:
+                pass
+            self._health_check = None
+        for index, pool in enumerate(self.pools):
+            if pool is not None:
+                await pool.close()
+                self.pools[index] = None
@@ -0,0 +1,231 @@
+import asyncio
+import bisect
+import collections
+import heapq
+import sys
+import zlib
+
+from .sql import DBAdapter, _parse_order, _RowChunks
+
+HASH = 'hash'
+RANGE = 'range'
+
+
+def _null_key(value) -> tuple:
+    '''
+    sort key placing None like postgres: last ascending, first descending (sorted with reverse=True)
+    '''
+    return value is None, value
+
+
+def _sort_rows(rows: list, order_by) -> list:
+    order = _parse_order(order_by)
+    for column, desc in reversed(order):
+        rows.sort(key=lambda row: _null_key(row[column]), reverse=desc)
+    return rows
+
+
+class ShardedAdapter:
+    '''
+    spreads tables over several databases by the value of shard_key.
+    rows are placed by a stable hash of the key, or by ranges when bounds is given:
+    bounds[i] is the exclusive upper bound of shard i and the last shard takes everything above.
+    lookups that pin the shard key (key=value or key__in) go to the owning shards, anything else runs
+    concurrently on every shard and the results are merged, ordered and limited.
+    writes take con either as one connection, when they reach a single shard, or as a dict of shard index
+    to connection; a transaction spans one database, so there is no atomicity across shards
+    '''
+
+    def __init__(self, shards: list, shard_key: str = 'id', bounds: list = None, **shared_settings):
+        self.shards = []
+        for shard in shards:
+            if not isinstance(shard, DBAdapter):
+                settings = dict(shared_settings)
+                settings.update(shard)
+                shard = DBAdapter(**settings)
+            self.shards.append(shard)
+
+        self.shard_key = shard_key
+        self.strategy = RANGE if bounds else HASH
+        self.bounds = list(bounds or [])
+        if self.strategy == RANGE and len(self.bounds) != len(self.shards) - 1:
+            raise ValueError('range sharding needs one bound less than the number of shards')
+
+    def shard_index(self, value) -> int:
+        if self.strategy == RANGE:
+            return bisect.bisect_right(self.bounds, value)
+        return zlib.crc32(str(value).encode()) % len(self.shards)
+
+    def shard_for(self, value) -> DBAdapter:
+        return self.shards[self.shard_index(value)]
+
+    def _targets(self, where_dict: dict) -> dict:
+        '''
+        :return: shard index to where dict, narrowing shard_key__in values per shard
+        '''
+        where_dict = where_dict or {}
+        if self.shard_key in where_dict:
+            return {self.shard_index(where_dict[self.shard_key]): where_dict}
+
+        in_key = self.shard_key + '__in'
+        if in_key in where_dict:
+            grouped = collections.defaultdict(list)
+            for value in where_dict[in_key]:
+                grouped[self.shard_index(value)].append(value)
+            targets = {}
+            for index, values in grouped.items():
+                targets[index] = dict(where_dict)
+                targets[index][in_key] = values
+            return targets
+
+        return {index: where_dict for index in range(len(self.shards))}
+
+    @staticmethod
+    def _connections(con, indexes) -> dict:
+        '''
+        :return: shard index to the caller's connection, a single connection can only serve a single shard
+        '''
+        if con is None:
+            return {}
+        if isinstance(con, dict):
+            return con
+        indexes = set(indexes)
+        if len(indexes) > 1:
+            raise ValueError('a connection belongs to one shard but this call reaches shards {}, '
+                             'pass con as a dict of shard index to connection'.format(sorted(indexes)))
+        return {index: con for index in indexes}
+
+    def acquire(self, *args, **kwargs):
+        raise TypeError('a sharded adapter has no connection of its own, acquire from shard_for(key) '
+                        'or one of shards')
+
+    @staticmethod
+    async def _gather(calls: list) -> list:
+        return list(await asyncio.gather(*calls))
+
+    @staticmethod
+    def _merge(results: list, offset=None, limit=None, order_by=None) -> list:
+        if len(results) == 1:
+            rows = list(results[0])
+        elif order_by:
+            order = _parse_order(order_by)
+            if len(set(desc for _, desc in order)) == 1:
+                columns = [column for column, _ in order]
+                rows = list(heapq.merge(*results, key=lambda row: [_null_key(row[column]) for column in columns],
+                                        reverse=order[0][1]))
+            else:
+                rows = _sort_rows([row for result in results for row in result], order_by)
+        else:
+            rows = [row for result in results for row in result]
+
+        offset = offset or 0
+        if limit:
+            return rows[offset:offset + limit]
+        return rows[offset:]
+
+    async def insert(self, con=None, table: str = '', value_dict: dict = None, **kwargs):
+        index = self.shard_index(value_dict[self.shard_key])
+        con = self._connections(con, [index]).get(index)
+        return await self.shards[index].insert(con, table, value_dict, **kwargs)
+
+    async def insert_many(self, con=None, table: str = '', rows=None, columns: list = None, chunk_size: int = 10000,
+                          **kwargs):
+        '''
+        rows may be a list or an async iterable, as for DBAdapter.insert_many. an async iterable is read chunk_size
+        rows at a time and each chunk is written to its shards before the next one is read, so every chunk commits
+        on its own unless con maps the shards to connections inside transactions
+        '''
+        returning = kwargs.get('returning')
+        results = []
+        count = 0
+        # plain iterables are grouped in one pass, keeping one insert_many (and transaction) per shard
+        chunks = _RowChunks(rows, columns, chunk_size if hasattr(rows, '__aiter__') else sys.maxsize)
+        async for chunk in chunks:
+            if not chunks.columns or self.shard_key not in chunks.columns:
+                raise ValueError('rows of a sharded insert_many need the shard key "{}"'.format(self.shard_key))
+            key_index = chunks.columns.index(self.shard_key)
+            grouped = collections.defaultdict(list)
+            for row in chunk:
+                grouped[self.shard_index(row[key_index])].append(row)
+
+            cons = self._connections(con, grouped)
+            for result in await self._gather([self.shards[index].insert_many(cons.get(index), table, shard_rows,
+                                                                             chunks.columns, chunk_size, **kwargs)
+                                              for index, shard_rows in grouped.items()]):
+                if returning:
+                    results.extend(result)
+                else:
+                    count += result
+        return results if returning else count
+
+    async def update(self, con=None, table: str = '', where_dict: dict = None, options: dict = None,
+                     **update_params):
+        targets = self._targets(where_dict)
+        cons = self._connections(con, targets)
+        results = await self._gather([self.shards[index].update(cons.get(index), table, shard_where, options,
+                                                                **update_params)
+                                      for index, shard_where in targets.items()])
+        if (options or {}).get('returning') is False:
+            return sum(results)
+        return [row for result in results for row in result]
+
+    async def delete(self, con=None, table: str = '', where_dict: dict = None, **kwargs):
+        targets = self._targets(where_dict)
+        cons = self._connections(con, targets)
+        results = await self._gather([self.shards[index].delete(cons.get(index), table, shard_where, **kwargs)
+                                      for index, shard_where in targets.items()])
+        if kwargs.get('returning'):
+            return [row for result in results for row in result]
+
+    async def execute(self, con=None, query: str = '', **kwargs):
+        '''
+        runs query on every shard
+        '''
+        cons = self._connections(con, range(len(self.shards)))
+        await self._gather([shard.execute(cons.get(index), query, **kwargs) for index, shard in enumerate(self.shards)])
+
+    async def select(self, table: str, offset=0, limit='ALL', order_by=None, columns='*', mapping=None,
+                     **kwargs):
+        shard_limit = None if limit == 'ALL' else (offset or 0) + limit
+        cons = self._connections(kwargs.pop('con', None), range(len(self.shards)))
+        results = await self._gather([shard.select(table, 0, shard_limit or 'ALL', order_by, columns, mapping=False,
+                                                   con=cons.get(index), **kwargs)
+                                      for index, shard in enumerate(self.shards)])
+        return self.shards[0]._map(self._merge(results, offset, shard_limit and limit, order_by), mapping)
+
+    async def where(self, table: str, offset=None, limit=None, order_by=None, columns='*', options: dict = None,
+                    **where_dict):
+        shard_limit = (offset or 0) + limit if limit else None
+        targets = self._targets(where_dict)
+        cons = self._connections((options or {}).get('con'), targets)
+        results = await self._gather([self.shards[index].where(table, None, shard_limit, order_by, columns,
+                                                               dict(options or {}, mapping=False,
+                                                                    con=cons.get(index)),
+                                                               **shard_where)
+                                      for index, shard_where in targets.items()])
+        return self.shards[0]._map(self._merge(results, offset, limit, order_by), (options or {}).get('mapping'))
+
+    async def count(self, table: str, where_dict: dict = None, **kwargs) -> int:
+        targets = self._targets(where_dict)
+        cons = self._connections(kwargs.pop('con', None), targets)
+        return sum(await self._gather([self.shards[index].count(table, shard_where, con=cons.get(index), **kwargs)
+                                       for index, shard_where in targets.items()]))
+
+    async def exists(self, table: str, where_dict: dict = None, **kwargs) -> bool:
+        targets = self._targets(where_dict)
+        cons = self._connections(kwargs.pop('con', None), targets)
+        return any(await self._gather([self.shards[index].exists(table, shard_where, con=cons.get(index), **kwargs)
+                                       for index, shard_where in targets.items()]))
+
+    async def estimated_count(self, table: str, where_dict: dict = None, **kwargs) -> int:
+        targets = self._targets(where_dict)
+        cons = self._connections(kwargs.pop('con', None), targets)
+        return sum(await self._gather([self.shards[index].estimated_count(table, shard_where, con=cons.get(index),
+                                                                          **kwargs)
+                                       for index, shard_where in targets.items()]))
+
+    async def warm_up(self, statements: list = None):
+        await self._gather([shard.warm_up(statements) for shard in self.shards])
+
+    async def close(self):
+        await self._gather([shard.close() for shard in self.shards])
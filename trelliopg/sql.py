@@ -1,11 +1,31 @@
+import asyncio
+import base64
+import datetime
+import decimal
 import functools
 import itertools
 import os
+import re
 import sys
+import time
+import uuid
 
 from asyncpg.connection import Connection
+from asyncpg.exceptions import DuplicatePreparedStatementError, InvalidSQLStatementNameError
 from asyncpg.pool import Pool, create_pool
 
+from .advisor import PlanAdvisor
+from .cache import MISS, ResultCache, written_tables
+from .codecs import map_rows, register_json_codecs, NAMEDTUPLE, SLOTS, TUPLE
+from .columnar import ColumnBatch, ColumnStream
+from .loader import BatchLoader
+from .metrics import Metrics
+from .notify import ChangeFeed, Subscription, _channel_name, drop_notify_trigger_ddl, notify_trigger_ddl
+from .stream import RecordStream
+from .writer import BufferedWriter, WriterOverflowError
+from .pool import Admission, CONNECTION_ERRORS, PoolGroup, PoolOverloadedError, PRIORITY_BACKGROUND, \
+    PRIORITY_CRITICAL, PRIORITY_NORMAL, ROUND_ROBIN
+
 PY_36 = sys.version_info >= (3, 6)
 
 try:
@@ -30,33 +50,112 @@ class AtomicExceptionHandler:
         return True
 
 
-def get_db_settings(config_file=None):
+DEFAULT_DATABASE = 'default'
+
+_settings_cache = dict()
+_adapters = dict()
+
+
+def _config_path(config_file=None):
     if not config_file:
         config_file = os.environ.get('CONFIG_FILE')
 
     if not config_file:
         config_file = './config.json'
 
-    with open(config_file) as f:
-        settings = json.load(f)
+    return config_file
+
+
+def _named_settings(settings: dict) -> dict:
+    '''
+    DATABASE_SETTINGS is either one database (its settings become "default")
+    or a mapping of names to database settings
+    '''
+    if settings and all(isinstance(value, dict) for value in settings.values()):
+        return settings
+    return {DEFAULT_DATABASE: settings}
+
 
-        if 'DATABASE_SETTINGS' not in settings.keys():
-            raise KeyError('"DATABASE_SETTINGS" key not found in config file')
+def get_db_settings(config_file=None, name: str = None):
+    config_file = _config_path(config_file)
 
-    return settings['DATABASE_SETTINGS']
+    if config_file not in _settings_cache:
+        with open(config_file) as f:
+            settings = json.load(f)
 
+            if 'DATABASE_SETTINGS' not in settings.keys():
+                raise KeyError('"DATABASE_SETTINGS" key not found in config file')
 
-def get_db_adapter(settings=None, config_file=None):
-    if not settings:
-        settings = get_db_settings(config_file)
+        _settings_cache[config_file] = settings['DATABASE_SETTINGS']
 
-    db_adapter = DBAdapter(**settings)
-    return db_adapter
+    if name is None:
+        return _settings_cache[config_file]
 
+    named = _named_settings(_settings_cache[config_file])
+    if name not in named:
+        raise KeyError('database "{}" not found in DATABASE_SETTINGS'.format(name))
+    return named[name]
 
-def async_atomic(on_exception=None, raise_exception=True, **kwargs):
+
+def create_db_adapter(settings: dict):
+    '''
+    DBAdapter for one database, or ShardedAdapter when settings has a "shards" list
+    '''
+    if 'shards' in settings:
+        from .shard import ShardedAdapter
+        return ShardedAdapter(**settings)
+    return DBAdapter(**settings)
+
+
+def get_db_adapter(settings=None, config_file=None, name: str = DEFAULT_DATABASE):
     '''
-    first argument will be a conn object
+    :param settings: creates a new, unregistered adapter from these settings
+    :return: the adapter registered as name in the config file, created on first use
+    '''
+    if settings:
+        return create_db_adapter(settings)
+
+    key = (_config_path(config_file), name)
+    if key not in _adapters:
+        _adapters[key] = create_db_adapter(get_db_settings(config_file, name))
+    return _adapters[key]
+
+
+async def _prepare(con: Connection, query: str):
+    '''
+    prepares query into the connection's statement cache, where execute, fetch and friends look it up.
+    Connection._get_statement(query, timeout) is private asyncpg api (checked against 0.32) and the only way
+    to fill that cache, Connection.prepare returns a statement the cache never sees. recheck on asyncpg upgrades
+    '''
+    await con._get_statement(query, None)
+
+
+def _in_transaction(con: Connection) -> bool:
+    try:
+        return con.is_in_transaction()
+    except Exception:
+        # released back to the pool, its transaction is over
+        return False
+
+
+def _flush_atomic(db: str, conn: Connection):
+    adapter = _adapters.get((_config_path(None), db))
+    if isinstance(adapter, DBAdapter) and not _in_transaction(conn):
+        adapter.flush_invalidations(conn)
+
+
+def _atomic_adapter(db: str):
+    adapter = get_db_adapter(name=db)
+    if not isinstance(adapter, DBAdapter):
+        raise TypeError('database "{}" is sharded, a transaction spans one database: pass a connection '
+                        'acquired from one of its shards'.format(db))
+    return adapter
+
+
+def async_atomic(on_exception=None, raise_exception=True, db: str = DEFAULT_DATABASE, **kwargs):
+    '''
+    first argument will be a conn object, pass it as con to adapter reads inside the transaction,
+    they run on a replica (or another primary connection) and miss its uncommitted writes otherwise
     :param func:
     :return:
     '''
@@ -74,8 +173,6 @@ def async_atomic(on_exception=None, raise_exception=True, **kwargs):
 
         on_exception = raise_exception
 
-    _db_adapter = get_db_adapter()
-
     def decorator(func):
         @functools.wraps(func)
         async def wrapped(self, *args, **kwargs):
@@ -85,30 +182,37 @@ def async_atomic(on_exception=None, raise_exception=True, **kwargs):
                     conn = i
                     break
             if not conn:
-                pool = await _db_adapter.get_pool()
-                async with pool.acquire() as conn:
+                adapter = _atomic_adapter(db)
+                async with adapter.acquire() as conn:
                     try:
                         async with conn.transaction():
                             kwargs['conn'] = conn
-                            return await func(self, *args, **kwargs)
+                            result = await func(self, *args, **kwargs)
                     except Exception as e:
                         return await on_exception(e)
+                    finally:
+                        adapter.flush_invalidations(conn)
+                    return result
             else:
                 try:
                     async with conn.transaction():
                         kwargs['conn'] = conn
-                        return await func(self, *args, **kwargs)
+                        result = await func(self, *args, **kwargs)
                 except Exception as e:
                     return await on_exception(e)
+                finally:
+                    _flush_atomic(db, conn)
+                return result
 
         return wrapped
 
     return decorator
 
 
-def async_atomic_func(on_exception=None, raise_exception=True, **kwargs):
+def async_atomic_func(on_exception=None, raise_exception=True, db: str = DEFAULT_DATABASE, **kwargs):
     '''
-    first argument will be a conn object
+    first argument will be a conn object, pass it as con to adapter reads inside the transaction,
+    they run on a replica (or another primary connection) and miss its uncommitted writes otherwise
     :param func:
     :return:
     '''
@@ -126,8 +230,6 @@ def async_atomic_func(on_exception=None, raise_exception=True, **kwargs):
 
         on_exception = raise_exception
 
-    _db_adapter = get_db_adapter()
-
     def decorator(func):
         @functools.wraps(func)
         async def wrapped(*args, **kwargs):
@@ -137,303 +239,1476 @@ def async_atomic_func(on_exception=None, raise_exception=True, **kwargs):
                     conn = i
                     break
             if not conn:
-                pool = await _db_adapter.get_pool()
+                adapter = _atomic_adapter(db)
                 try:
-                    async with pool.acquire() as conn:
-                        async with conn.transaction():
-                            kwargs['conn'] = conn
-                            return await func(*args, **kwargs)
+                    async with adapter.acquire() as conn:
+                        try:
+                            async with conn.transaction():
+                                kwargs['conn'] = conn
+                                return await func(*args, **kwargs)
+                        finally:
+                            adapter.flush_invalidations(conn)
                 except Exception as e:
                     return await on_exception(e)
             else:
                 try:
                     async with conn.transaction():
                         kwargs['conn'] = conn
-                        return await func(*args, **kwargs)
+                        result = await func(*args, **kwargs)
                 except Exception as e:
                     return await on_exception(e)
+                finally:
+                    _flush_atomic(db, conn)
+                return result
 
         return wrapped
 
     return decorator
 
 
-class Borg:
-    __shared_state = dict()
+LOOKUP_OPERATORS = {
+    'in': '= any(${})',
+    'not_in': '<> all(${})',
+    'lt': '< ${}',
+    'lte': '<= ${}',
+    'gt': '> ${}',
+    'gte': '>= ${}',
+    'contains': 'like ${}',
+    'icontains': 'ilike ${}',
+    'startswith': 'like ${}',
+    'istartswith': 'ilike ${}',
+    'endswith': 'like ${}',
+    'iendswith': 'ilike ${}',
+}
 
-    def __init__(self):
-        self.__dict__ = self.__shared_state
+LOOKUP_PATTERNS = {
+    'contains': '%{}%',
+    'icontains': '%{}%',
+    'startswith': '{}%',
+    'istartswith': '{}%',
+    'endswith': '%{}',
+    'iendswith': '%{}',
+}
 
+QUERY_CACHE_SIZE = 1024
 
-class DBAdapter(Borg):
-    INSERT = """INSERT INTO {table} ({columns}) VALUES ({values}) RETURNING *;"""
-    SELECT = """SELECT {columns} FROM {table}"""
-    UPDATE = """UPDATE {table} SET {values} {where} RETURNING *"""
-    DELETE = """DELETE FROM {table} {where}"""
-    WHERE = """ {key} = '{value}'"""
+WHERE_OPTIONS = ('use_primary', 'timeout', 'priority', 'undefer', 'mapping', 'con')
+UPDATE_OPTIONS = ('autocommit', 'timeout', 'priority', 'returning')
 
-    def __init__(self, database: str = '', user: str = '', password: str = '', host: str = 'localhost',
-                 port: int = 5432, min_size=5, max_size=10, max_queries=50000, setup=None, loop=None, **kwargs):
+POOLER_IDLE_LIFETIME = 60
+STATEMENT_ERRORS = (InvalidSQLStatementNameError, DuplicatePreparedStatementError)
 
-        super(DBAdapter, self).__init__()
-        self._dsn = dict()
-        self._dsn['database'] = database
-        self._dsn['user'] = user
-        self._dsn['password'] = password
-        self._dsn['host'] = host
-        self._dsn['port'] = port
+SEARCH_ILIKE = 'ilike'
+SEARCH_FULLTEXT = 'fulltext'
+SEARCH_TRIGRAM = 'trigram'
 
-        self._params = dict()
-        self._params['dsn'] = 'postgres://{user}:{password}@{host}:{port}/{database}'.format(**self._dsn)
-        self._params['min_size'] = min_size
-        self._params['max_size'] = max_size
-        self._params['max_queries'] = max_queries
-        self._params['setup'] = setup
-        self._params['loop'] = loop
-        self._params.update(kwargs)
 
-        self.pool = None
+def _split_lookup(key, default):
+    split_key = key.split('__')
+    if len(split_key) > 1 and split_key[1] in LOOKUP_OPERATORS:
+        return split_key[0], split_key[1]
+    return split_key[0], default
 
-        if PY_36:
-            self._compat()
 
-    async def get_pool(self) -> Pool:
-        if not self.pool:
-            self.pool = await create_pool(**self._params)
-        return self.pool
+def _lookup_value(lookup, value):
+    if lookup in LOOKUP_PATTERNS:
+        return LOOKUP_PATTERNS[lookup].format(value)
+    if lookup in ('in', 'not_in'):
+        return list(value)
+    return value
 
-    async def insert(self, con: Connection = None, table: str = '', value_dict: dict = None):
 
-        columns = ",".join(value_dict.keys())
-        placeholder = ",".join(['${}'.format(i) for i in range(1, len(value_dict) + 1)])
+def _call_options(options: dict, allowed: tuple) -> dict:
+    '''
+    call options of methods taking columns as keyword arguments, passed as a dict so they never shadow a column
+    '''
+    options = options or {}
+    unknown = sorted(key for key in options if key not in allowed)
+    if unknown:
+        raise TypeError('unknown options {}, expected any of {}'.format(', '.join(unknown), ', '.join(allowed)))
+    return options
 
-        query = self.INSERT.format(table=table, columns=columns, values=placeholder)
 
-        if not con:
-            pool = await self.get_pool()
-            async with pool.acquire() as con:
-                async with con.transaction():
-                    result = await con.fetchrow(query, *value_dict.values())
+def _where_shape(where_dict, offset=None, limit=None, order_by=None, update_query=False, start=1):
+    '''
+    splits a where dict into a hashable query shape and its positional arguments,
+    calls with the same shape compile to the same sql text
+    '''
+    args = []
+    search_shape = ()
+    where_keys = ()
+
+    if where_dict:
+        search = where_dict.get('search')
+        if isinstance(search, dict):
+            search_shape, search_args = _search_shape(search, rank=not update_query)
+            args.extend(search_args)
         else:
-            async with con.transaction():
-                result = await con.fetchrow(query, *value_dict.values())
+            search = None
 
-        return result
+        where_keys = tuple((key, where_dict[key] is None) for key in where_dict.keys()
+                           if search is None or key != 'search')
+        for key, is_null in where_keys:
+            lookup = _split_lookup(key, None)[1]
+            if not is_null:
+                args.append(_lookup_value(lookup, where_dict[key]))
+            elif lookup is not None:
+                # only key=None compiles to "is null", any other lookup would get a placeholder without argument
+                raise ValueError('None is only supported for equality lookups, got {}=None'.format(key))
 
-    async def update(self, con: Connection = None, table: str = '', where_dict: dict = None,
-                     **update_params: dict) -> list:
+    if update_query:
+        order_by, offset, limit = None, None, None
+    if offset:
+        args.append(offset)
+    if limit:
+        args.append(limit)
 
-        values_list = ["{}='{}'".format(k, v) for k, v in update_params.items() if v is not None]
-        values_list.extend(["{}=null".format(k, v) for k, v in update_params.items() if v is None])
-        values = ','.join(values_list)
+    return (search_shape, where_keys, order_by, bool(offset), bool(limit), start), args
 
-        where = ''
-        if where_dict is not None:
-            # where = ' where '
-            # where += ' and '.join([self.WHERE.format(key=k, value=v) for k, v in where_dict.items()])
-            where = self._where_query(where_dict, update_query=True)
-        query = self.UPDATE.format(table=table, values=values, where=where)
 
-        if not con:
-            pool = await self.get_pool()
-            async with pool.acquire() as con:
-                async with con.transaction():
-                    results = await con.fetch(query)
+def _search_shape(search: dict, rank: bool = True) -> tuple:
+    '''
+    search dict keys: columns, term, and optionally
+    mode (ilike, fulltext or trigram), config (text search configuration for fulltext)
+    and rank (order by relevance, fulltext and trigram only)
+    '''
+    columns = tuple(search.get('columns', []))
+    term = search.get('term', '')
+    mode = search.get('mode', SEARCH_ILIKE)
+    config = search.get('config', 'english')
+    if not columns:
+        return (), []
+
+    if mode == SEARCH_ILIKE:
+        return (mode, None, False, columns), [_lookup_value(_split_lookup(key, 'icontains')[1], term)
+                                              for key in columns]
+    if mode not in (SEARCH_FULLTEXT, SEARCH_TRIGRAM):
+        raise ValueError('unknown search mode "{}"'.format(mode))
+    if not re.match(r'^\w+$', config):
+        raise ValueError('invalid text search config "{}"'.format(config))
+    columns = tuple(_split_lookup(key, None)[0] for key in columns)
+    return (mode, config, bool(rank and search.get('rank')), columns), [term]
+
+
+def _tsvector(columns, config: str) -> str:
+    document = " || ' ' || ".join("coalesce({}, '')".format(column) for column in columns)
+    return "to_tsvector('{}', {})".format(config, document)
+
+
+def _compile_search(search_shape, index) -> tuple:
+    '''
+    :return: (search condition, rank ordering or None)
+    '''
+    if not search_shape:
+        return '', None
+
+    mode, config, rank, columns = search_shape
+    if mode == SEARCH_ILIKE:
+        search_list = []
+        for key in columns:
+            column, lookup = _split_lookup(key, 'icontains')
+            search_list.append('{} {}'.format(column, LOOKUP_OPERATORS[lookup].format(next(index))))
+        return ' or '.join(search_list), None
+
+    placeholder = '${}'.format(next(index))
+    if mode == SEARCH_FULLTEXT:
+        vector = _tsvector(columns, config)
+        tsquery = "websearch_to_tsquery('{}', {})".format(config, placeholder)
+        return '{} @@ {}'.format(vector, tsquery), 'ts_rank({}, {}) desc'.format(vector, tsquery) if rank else None
+
+    condition = ' or '.join('{} % {}'.format(column, placeholder) for column in columns)
+    similarity = ','.join('similarity({}, {})'.format(column, placeholder) for column in columns)
+    return condition, 'greatest({}) desc'.format(similarity) if rank else None
+
+
+def _where_arg_count(shape) -> int:
+    search_shape, where_keys = shape[0], shape[1]
+    count = sum(1 for _, is_null in where_keys if not is_null)
+    if search_shape:
+        count += len(search_shape[3]) if search_shape[0] == SEARCH_ILIKE else 1
+    return count
+
+
+@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _compile_where(search_shape, where_keys, order_by, has_offset, has_limit, start=1):
+    index = itertools.count(start)
+    query = ''
+
+    search_query, rank = _compile_search(search_shape, index)
+
+    where_list = []
+    for key, is_null in where_keys:
+        column, lookup = _split_lookup(key, None)
+        if lookup is None:
+            operator = 'is null' if is_null else '= ${}'.format(next(index))
         else:
-            async with con.transaction():
-                results = await con.fetch(query)
-
-        return results
-
-    async def delete(self, con: Connection = None, table: str = '', where_dict: dict = None):
-        where = ' where '
-        where += ' and '.join([self.WHERE.format(key=k, value=v) for k, v in where_dict.items()])
-        query = self.DELETE.format(table=table, where=where)
-
-        if not con:
-            pool = await self.get_pool()
-            async with pool.acquire() as con:
-                async with con.transaction():
-                    await con.execute(query)
+            operator = LOOKUP_OPERATORS[lookup].format(next(index))
+        where_list.append('{} {}'.format(column, operator))
+
+    where_query = ' and '.join(where_list)
+    if search_query and where_query:
+        query += ' where (' + search_query + ') and (' + where_query + ') '
+    elif search_query:
+        query += ' where ' + search_query
+    elif where_query:
+        query += ' where ' + where_query
+
+    if rank:
+        order_by = rank + (',' + order_by if order_by else '')
+    if order_by:
+        query += ' order by {}'.format(order_by)
+    if has_offset:
+        query += ' offset ${}'.format(next(index))
+    if has_limit:
+        query += ' limit ${}'.format(next(index))
+
+    return query
+
+
+@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _compile_select(template, table, columns, shape):
+    return template.format(columns=columns, table=table) + _compile_where(*shape)
+
+
+AGGREGATES = ('count', 'sum', 'min', 'max', 'avg')
+
+
+@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _compile_aggregate(table, aggregates, group_by, shape, order_by):
+    selected = list(group_by)
+    for alias, (function, column) in aggregates:
+        if function not in AGGREGATES:
+            raise ValueError('unknown aggregate "{}"'.format(function))
+        selected.append('{}({}) AS {}'.format(function, column, alias))
+
+    query = 'SELECT {} FROM {}'.format(','.join(selected), table) + _compile_where(*shape)
+    if group_by:
+        query += ' group by ' + ','.join(group_by)
+    if order_by:
+        query += ' order by ' + order_by
+    return query
+
+
+def _parse_order(order_by) -> tuple:
+    if isinstance(order_by, str):
+        order_by = order_by.split(',')
+    order = []
+    for item in order_by:
+        parts = item.split()
+        order.append((parts[0], len(parts) > 1 and parts[1].lower() == 'desc'))
+    return tuple(order)
+
+
+@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _compile_keyset(template, table, columns, shape, order, has_after):
+    query = template.format(columns=columns, table=table)
+    where = _compile_where(*shape)
+    conditions = ['(' + where[len(' where '):] + ')'] if where else []
+    index = itertools.count(shape[-1] + _where_arg_count(shape))
+
+    if has_after:
+        placeholders = ['${}'.format(next(index)) for _ in order]
+        if len(set(desc for _, desc in order)) == 1:
+            conditions.append('({}) {} ({})'.format(','.join(column for column, _ in order),
+                                                    '<' if order[0][1] else '>', ','.join(placeholders)))
         else:
-            async with con.transaction():
-                await con.execute(query)
+            expanded = []
+            for i, (column, desc) in enumerate(order):
+                equal = ['{} = {}'.format(order[j][0], placeholders[j]) for j in range(i)]
+                expanded.append('(' + ' and '.join(equal + ['{} {} {}'.format(
+                    column, '<' if desc else '>', placeholders[i])]) + ')')
+            conditions.append('(' + ' or '.join(expanded) + ')')
+
+    if conditions:
+        query += ' where ' + ' and '.join(conditions)
+    query += ' order by ' + ','.join('{} {}'.format(column, 'desc' if desc else 'asc') for column, desc in order)
+    query += ' limit ${}'.format(next(index))
+    return query
+
+
+_TOKEN_TYPES = (
+    ('dtz', lambda v: isinstance(v, datetime.datetime) and v.tzinfo is not None,
+     lambda v: v.strftime('%Y-%m-%dT%H:%M:%S.%f%z'),
+     lambda v: datetime.datetime.strptime(v, '%Y-%m-%dT%H:%M:%S.%f%z')),
+    ('dt', lambda v: isinstance(v, datetime.datetime),
+     lambda v: v.strftime('%Y-%m-%dT%H:%M:%S.%f'),
+     lambda v: datetime.datetime.strptime(v, '%Y-%m-%dT%H:%M:%S.%f')),
+    ('d', lambda v: isinstance(v, datetime.date), datetime.date.isoformat,
+     lambda v: datetime.datetime.strptime(v, '%Y-%m-%d').date()),
+    ('dec', lambda v: isinstance(v, decimal.Decimal), str, decimal.Decimal),
+    ('uuid', lambda v: isinstance(v, uuid.UUID), str, uuid.UUID),
+)
+_TOKEN_DECODERS = {tag: load for tag, _, _, load in _TOKEN_TYPES}
+
+
+def encode_keyset_token(values) -> str:
+    encoded = []
+    for value in values:
+        for tag, match, dump, _ in _TOKEN_TYPES:
+            if match(value):
+                value = {tag: dump(value)}
+                break
+        encoded.append(value)
+    return base64.urlsafe_b64encode(json.dumps(encoded).encode()).decode()
+
+
+def decode_keyset_token(token: str) -> list:
+    values = []
+    for value in json.loads(base64.urlsafe_b64decode(token.encode()).decode()):
+        if isinstance(value, dict) and len(value) == 1:
+            tag, raw = next(iter(value.items()))
+            if tag in _TOKEN_DECODERS:
+                value = _TOKEN_DECODERS[tag](raw)
+        values.append(value)
+    return values
+
+
+class KeysetPages:
+    '''
+    async iterator over every page of a table in keyset order
+    '''
 
-    async def execute(self, con: Connection = None, query: str = ''):
-        if not con:
-            pool = await self.get_pool()
-            async with pool.acquire() as con:
-                async with con.transaction():
-                    await con.execute(query)
+    def __init__(self, adapter, table, order_by, page_size, kwargs):
+        self.adapter = adapter
+        self.table = table
+        self.order_by = order_by
+        self.page_size = page_size
+        self.kwargs = kwargs
+        self.after = None
+        self._done = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._done:
+            raise StopAsyncIteration
+        rows, self.after = await self.adapter.keyset(self.table, order_by=self.order_by, after=self.after,
+                                                     limit=self.page_size, **self.kwargs)
+        if self.after is None:
+            self._done = True
+        if not rows:
+            raise StopAsyncIteration
+        return rows
+
+
+def _hashable_columns(columns):
+    if isinstance(columns, list):
+        return tuple(columns)
+    return columns
+
+
+def _column_batches(rows, columns, batch_size, unique: tuple = None) -> tuple:
+    '''
+    :param unique: key columns rows must not repeat, only the last row of each key is kept
+    '''
+    if columns is None:
+        if not isinstance(rows[0], dict):
+            raise ValueError('columns are required when rows are tuples')
+        columns = list(rows[0].keys())
+
+    records = [tuple(row[column] for column in columns) if isinstance(row, dict) else tuple(row) for row in rows]
+    if unique:
+        positions = [columns.index(column) for column in unique]
+        last = {tuple(record[i] for i in positions): index for index, record in enumerate(records)}
+        if len(last) < len(records):
+            records = [records[index] for index in sorted(last.values())]
+    return tuple(columns), [records[i:i + batch_size] for i in range(0, len(records), batch_size)]
+
+
+def _returning_columns(table, returning):
+    if isinstance(returning, str):
+        returning = [column.strip() for column in returning.split(',')]
+    return ','.join('{}.{}'.format(table, column) for column in returning)
+
+
+@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _compile_upsert(table, columns, types, conflict_columns, update_columns, returning):
+    query = 'INSERT INTO {table} ({columns}) SELECT * FROM unnest({arrays}) ON CONFLICT ({conflict}) '.format(
+        table=table, columns=','.join(columns), conflict=','.join(conflict_columns),
+        arrays=','.join('${}::{}[]'.format(i, t) for i, t in enumerate(types, 1)))
+    if update_columns:
+        query += 'DO UPDATE SET ' + ','.join('{0} = EXCLUDED.{0}'.format(column) for column in update_columns)
+    else:
+        query += 'DO NOTHING'
+    if returning:
+        query += ' RETURNING ' + _returning_columns(table, returning)
+    return query
+
+
+@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _compile_update_many(table, columns, types, key_columns, returning):
+    query = 'UPDATE {table} SET {values} FROM unnest({arrays}) AS _v({columns}) WHERE {keys}'.format(
+        table=table, columns=','.join(columns),
+        values=','.join('{0} = _v.{0}'.format(column) for column in columns if column not in key_columns),
+        arrays=','.join('${}::{}[]'.format(i, t) for i, t in enumerate(types, 1)),
+        keys=' and '.join('{0}.{1} = _v.{1}'.format(table, column) for column in key_columns))
+    if returning:
+        query += ' RETURNING ' + _returning_columns(table, returning)
+    return query
+
+
+class _RowChunks:
+    def __init__(self, rows, columns=None, chunk_size=10000):
+        self.columns = list(columns) if columns else None
+        self.chunk_size = chunk_size
+        if hasattr(rows, '__aiter__'):
+            self._aiter = rows.__aiter__()
+            self._iter = None
         else:
-            async with con.transaction():
-                await con.execute(query)
+            self._aiter = None
+            self._iter = iter(rows)
+
+    def __aiter__(self):
+        return self
+
+    async def _next_row(self):
+        if self._aiter is not None:
+            return await self._aiter.__anext__()
+        try:
+            return next(self._iter)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    def _to_record(self, row):
+        if isinstance(row, dict):
+            if self.columns is None:
+                self.columns = list(row.keys())
+            return tuple(row[column] for column in self.columns)
+        return tuple(row)
+
+    async def __anext__(self):
+        chunk = []
+        while len(chunk) < self.chunk_size:
+            try:
+                row = await self._next_row()
+            except StopAsyncIteration:
+                break
+            chunk.append(self._to_record(row))
+        if not chunk:
+            raise StopAsyncIteration
+        return chunk
+
+
+class _Timed:
+    '''
+    times the statements of one adapter call for metrics, entered once the connection is acquired so pool waits
+    are not counted. a call that raises is recorded with the class name of the exception as error
+    '''
 
-    async def select(self, table: str, offset=0, limit='ALL', order_by='created desc', columns='*') -> list:
-        if isinstance(columns, list):
-            columns = ','.join(columns)
-        query = self.SELECT.format(columns=columns, table=table)
-        query += ' order by $1 offset $2 limit $3'
+    def __init__(self, adapter, method: str, table: str, query: str = '', rows: int = 0):
+        self.adapter = adapter
+        self.method = method
+        self.table = table
+        self.query = query
+        self.rows = rows
+        self.elapsed = 0.0
+        self._started = None
+
+    def __enter__(self):
+        self._started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.elapsed = time.monotonic() - self._started
+        self.adapter._record(self.method, self.table, self.query, self.elapsed, self.rows,
+                             exc_type.__name__ if exc_type is not None else None)
+
+
+class _Acquire:
+    def __init__(self, adapter, readonly=False, priority=PRIORITY_NORMAL, timeout=None):
+        self.adapter = adapter
+        self.readonly = readonly
+        self.priority = priority
+        self.timeout = timeout if timeout is not None else adapter.acquire_timeout
+        self._admission = None
+        self._context = None
+        self._con = None
+
+    async def __aenter__(self) -> Connection:
+        while True:
+            pool = await self.adapter.get_pool(readonly=self.readonly)
+            try:
+                return await self._enter(pool)
+            except CONNECTION_ERRORS:
+                # a replica died after its pool was created: skip it until retry_interval passes and try the
+                # next one, or the primary once none is left
+                replicas = self.adapter.replicas
+                if not self.readonly or not replicas or not replicas.mark_pool_down(pool):
+                    raise
+
+    async def _enter(self, pool: Pool) -> Connection:
+        metrics = self.adapter.metrics
+        if metrics is None and self.adapter.max_waiters is None:
+            self._context = pool.acquire(timeout=self.timeout)
+            self._con = await self._context.__aenter__()
+            return self._con
+
+        started = time.monotonic()
+        timeout = self.timeout
+        if self.adapter.max_waiters is not None:
+            admission = self.adapter._admission(pool)
+            await admission.acquire(self.priority, timeout)
+            self._admission = admission
+            if timeout is not None:
+                timeout = max(timeout - (time.monotonic() - started), 0)
+
+        try:
+            self._context = pool.acquire(timeout=timeout)
+            con = await self._context.__aenter__()
+        except BaseException:
+            self._release_admission()
+            raise
+
+        if metrics is not None:
+            metrics.acquire(time.monotonic() - started)
+        self._con = con
+        return con
+
+    def _release_admission(self):
+        admission, self._admission = self._admission, None
+        if admission is not None:
+            admission.release()
 
-        pool = await self.get_pool()
-        async with pool.acquire() as con:
-            stmt = await con.prepare(query)
-            results = await stmt.fetch(order_by, offset, limit)
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if self.adapter._pending_invalidations:
+                self.adapter.flush_invalidations(self._con)
+            return await self._context.__aexit__(exc_type, exc_val, exc_tb)
+        finally:
+            self._release_admission()
 
-        return results
 
-    async def where(self, table: str, offset=None, limit=None, order_by=None, columns='*', **where_dict: dict) -> list:
-        if isinstance(columns, list):
-            columns = ','.join(columns)
-        query = self.SELECT.format(columns=columns, table=table)
-        query += self._where_query(where_dict, offset, limit, order_by)
+class _NoTransaction:
+    async def __aenter__(self):
+        pass
 
-        pool = await self.get_pool()
-        async with pool.acquire() as con:
-            results = await con.fetch(query)
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        pass
 
-        return results
 
-    @staticmethod
-    def _where_query(where_dict, offset=None, limit=None, order_by=None, update_query=False):
-        query = ''
+_NO_TRANSACTION = _NoTransaction()
 
-        if where_dict:
-            query += ' where '
 
-            where_query = None
-            search_query = None
-            if where_dict.get('search') and isinstance(where_dict.get('search'), dict):
-                _search = where_dict.pop('search')
-                search_columns = _search.get('columns', [])
-                search_term = _search.get('term', '')
-                search_list = []
+class DBAdapter:
+    INSERT = """INSERT INTO {table} ({columns}) VALUES ({values}){returning};"""
+    SELECT = """SELECT {columns} FROM {table}"""
+    UPDATE = """UPDATE {table} SET {values} {where}{returning}"""
+    DELETE = """DELETE FROM {table} {where}{returning}"""
+    DSN = 'postgres://{user}:{password}@{host}:{port}/{database}'
 
-                for key in search_columns:
-                    column = key
-                    operator = 'ilike'
-                    value = "'%{}%'".format(search_term)
+    def __init__(self, database: str = '', user: str = '', password: str = '', host: str = 'localhost',
+                 port: int = 5432, min_size=5, max_size=10, max_queries=50000, setup=None, loop=None,
+                 replicas: list = None, replica_selection: str = ROUND_ROBIN, replica_retry_interval: float = 30,
+                 result_cache=None, instrumentation=None, autocommit: bool = False, statements: list = None,
+                 codecs: list = None, acquire_timeout: float = None, max_waiters: int = None,
+                 statement_timeout: float = None, returning: dict = None, deferred: dict = None,
+                 json_codecs: bool = False, row_mapping=None, plan_capture=None, pgbouncer: bool = False,
+                 **kwargs):
 
-                    split_key = key.split('__')
-                    if len(split_key) > 1:
-                        column = split_key[0]
-                        spliter = split_key[1]
+        self._dsn = dict()
+        self._dsn['database'] = database
+        self._dsn['user'] = user
+        self._dsn['password'] = password
+        self._dsn['host'] = host
+        self._dsn['port'] = port
 
-                        if spliter == 'contains':
-                            operator = 'like'
-                            value = "'%{}%'".format(search_term)
+        self._user_init = kwargs.pop('init', None)
+        self.statements = list(statements or [])
+        self.codecs = list(codecs or [])
+        if json_codecs:
+            self.codecs.append(register_json_codecs)
+        self.row_mapping = row_mapping
+
+        params = dict()
+        params['dsn'] = self.DSN.format(**self._dsn)
+        params['min_size'] = min_size
+        params['max_size'] = max_size
+        params['max_queries'] = max_queries
+        params['setup'] = setup
+        params['loop'] = loop
+        params.update(kwargs)
+        if pgbouncer:
+            # a transaction pooler hands each transaction to any server connection, so nothing may outlive one:
+            # unnamed statements only, and statement_timeout is enforced client side instead of as a startup
+            # parameter the pooler would reject. min_size and max_size count connections to the pooler
+            params['statement_cache_size'] = 0
+            params.setdefault('max_inactive_connection_lifetime', POOLER_IDLE_LIFETIME)
+        elif statement_timeout:
+            server_settings = dict(params.get('server_settings') or {})
+            server_settings.setdefault('statement_timeout', str(int(statement_timeout * 1000)))
+            params['server_settings'] = server_settings
+
+        params['init'] = self._init_connection
+        self._params = params
+        self.pgbouncer = pgbouncer
+        self.pool = None
+        self._pool_creation = None
+        self.autocommit = autocommit
+        self.acquire_timeout = acquire_timeout
+        self.max_waiters = max_waiters
+        self.statement_timeout = statement_timeout
+        self._admissions = dict()
+        self.returning = returning or {}
+        self.deferred = deferred or {}
+        self._projections = dict()
+
+        self.replicas = None
+        if replicas:
+            self.replicas = PoolGroup([self._replica_params(replica) for replica in replicas],
+                                      selection=replica_selection, retry_interval=replica_retry_interval)
+
+        self.cache = None
+        self._pending_invalidations = dict()
+        if isinstance(result_cache, ResultCache):
+            self.cache = result_cache
+        elif result_cache:
+            self.cache = ResultCache(**result_cache)
+
+        self._loaders = dict()
+        self._writer = None
+        self._feed = None
+        self._column_types = dict()
+
+        self.metrics = None
+        if isinstance(instrumentation, dict):
+            self.metrics = Metrics(**instrumentation)
+        elif instrumentation:
+            self.metrics = instrumentation
+        if isinstance(self.metrics, Metrics):
+            self.metrics.pool_stats = self.pool_stats
+
+        self.advisor = None
+        if isinstance(plan_capture, dict):
+            self.advisor = PlanAdvisor(self, **plan_capture)
+        elif plan_capture:
+            self.advisor = plan_capture
 
-                        if spliter == 'icontains':
-                            operator = 'ilike'
-                            value = "'%{}%'".format(search_term)
+        if PY_36:
+            self._compat()
 
-                        if spliter == 'startswith':
-                            operator = 'like'
-                            value = "'{}%'".format(search_term)
+    def _replica_params(self, replica) -> dict:
+        '''
+        :param replica: "host", "host:port" or a dict overriding any of the primary dsn keys
+        '''
+        if not isinstance(replica, dict):
+            host, _, port = str(replica).partition(':')
+            replica = {'host': host}
+            if port:
+                replica['port'] = int(port)
+
+        dsn = dict(self._dsn)
+        dsn.update(replica)
+        params = dict(self._params)
+        params['dsn'] = self.DSN.format(**dsn)
+        return params
+
+    async def get_pool(self, readonly: bool = False) -> Pool:
+        if readonly and self.replicas:
+            pool = await self.replicas.get_pool()
+            if pool is not None:
+                return pool
 
-                        if spliter == 'istartswith':
-                            operator = 'ilike'
-                            value = "'{}%'".format(search_term)
+        if not self.pool:
+            # single flight, concurrent first callers wait on the same pool creation
+            if self._pool_creation is None:
+                self._pool_creation = asyncio.ensure_future(create_pool(**self._params))
+                self._pool_creation.add_done_callback(self._pool_created)
+            await asyncio.shield(self._pool_creation)
+        return self.pool
 
-                        if spliter == 'endswith':
-                            operator = 'like'
-                            value = "'%{}'".format(search_term)
+    def _pool_created(self, creation: asyncio.Future):
+        self._pool_creation = None
+        if not creation.cancelled() and creation.exception() is None:
+            self.pool = creation.result()
+
+    def register_statement(self, query: str):
+        '''
+        prepares query on every new pool connection, so the first execution skips parse and plan.
+        ignored in pgbouncer mode, where prepared statements do not survive the transaction
+        '''
+        if query not in self.statements:
+            self.statements.append(query)
+
+    async def _init_connection(self, con: Connection):
+        if self._user_init is not None:
+            await self._user_init(con)
+        for codec in self.codecs:
+            await codec(con)
+        if not self.pgbouncer:
+            for query in self.statements:
+                await _prepare(con, query)
+
+    async def warm_up(self, statements: list = None):
+        '''
+        creates the primary and replica pools, opening min_size connections each,
+        and prepares the registered statements on all of them
+        '''
+        for query in statements or []:
+            self.register_statement(query)
+
+        pools = [await self.get_pool()]
+        if self.replicas:
+            pools.extend(await self.replicas.open())
+
+        for pool in pools:
+            connections = []
+            try:
+                for _ in range(pool.get_min_size()):
+                    connections.append(await pool.acquire())
+                for con in connections:
+                    if not self.pgbouncer:
+                        for query in self.statements:
+                            await _prepare(con, query)
+            finally:
+                for con in connections:
+                    await pool.release(con)
+
+    def acquire(self, readonly: bool = False, priority: int = PRIORITY_NORMAL, timeout: float = None) -> _Acquire:
+        '''
+        async context manager for a pool connection, a replica one when readonly
+        :param priority: PRIORITY_CRITICAL, PRIORITY_NORMAL or PRIORITY_BACKGROUND, lower values are served
+        first when max_waiters is set, critical callers are never rejected
+        :param timeout: seconds to wait for a connection, defaults to acquire_timeout
+        '''
+        return _Acquire(self, readonly, priority, timeout)
+
+    def _admission(self, pool: Pool) -> Admission:
+        admission = self._admissions.get(pool)
+        if admission is None:
+            admission = self._admissions[pool] = Admission(pool.get_max_size(), self.max_waiters)
+        return admission
+
+    def _timeout(self, timeout: float = None):
+        return timeout if timeout is not None else self.statement_timeout
+
+    def pool_stats(self) -> list:
+        pools = [('primary', self.pool)]
+        if self.replicas:
+            pools.extend(('replica{}'.format(i), pool) for i, pool in enumerate(self.replicas.pools))
+
+        stats = []
+        for name, pool in pools:
+            if pool is not None:
+                size, idle = pool.get_size(), pool.get_idle_size()
+                stats.append({'pool': name, 'size': size, 'idle': idle, 'in_use': size - idle,
+                              'max_size': pool.get_max_size()})
+        return stats
+
+    def _transaction(self, con: Connection, autocommit: bool = None, single_statement: bool = True):
+        '''
+        transaction for a write, skipped in autocommit mode when it would only wrap a single statement
+        or add a savepoint inside a transaction the caller already opened
+        '''
+        if autocommit is None:
+            autocommit = self.autocommit
+        if autocommit and (single_statement or con.is_in_transaction()):
+            return _NO_TRANSACTION
+        return con.transaction()
+
+    def _returning(self, table: str, returning, default) -> str:
+        '''
+        :return: RETURNING clause for returning, True or None fall back to the table setting, then to default
+        '''
+        if returning is None or returning is True:
+            returning = self.returning.get(table, default)
+        if not returning:
+            return ''
+        if isinstance(returning, (list, tuple)):
+            returning = ','.join(returning)
+        return ' RETURNING ' + returning
 
-                        if spliter == 'iendswith':
-                            operator = 'ilike'
-                            value = "'%{}'".format(search_term)
+    @staticmethod
+    def _run_returning(returning: str, one: bool = False):
+        async def run(con, query, *args, timeout=None):
+            if returning and one:
+                return await con.fetchrow(query, *args, timeout=timeout)
+            if returning:
+                return await con.fetch(query, *args, timeout=timeout)
+            status = await con.execute(query, *args, timeout=timeout)
+            return None if one else int(status.split()[-1])
+
+        return run
+
+    def _timed(self, method: str, table: str, query: str = '', rows: int = 0) -> _Timed:
+        return _Timed(self, method, table, query, rows)
+
+    def _record(self, method: str, table: str, query: str, elapsed: float, rows: int = 0, error: str = None):
+        if self.metrics is not None:
+            self.metrics.query(method, table, query, elapsed, rows, error=error)
+
+    async def insert(self, con: Connection = None, table: str = '', value_dict: dict = None, autocommit: bool = None,
+                     timeout: float = None, priority: int = PRIORITY_NORMAL, returning=None):
+        '''
+        :param returning: columns of the inserted row to return, False for none (returns None),
+        defaults to the table's returning setting or *
+        '''
+        columns = ",".join(value_dict.keys())
+        placeholder = ",".join(['${}'.format(i) for i in range(1, len(value_dict) + 1)])
+        returning = self._returning(table, returning, '*')
 
-                    placeholder = "{} {} {}".format(column, operator, value)
-                    search_list.append(placeholder)
+        query = self.INSERT.format(table=table, columns=columns, values=placeholder, returning=returning)
+        run = self._run_returning(returning, one=True)
 
-                search_query = ' or '.join(search_list)
+        timed = self._timed('insert', table, query, 1)
+        if not con:
+            async with self.acquire(priority=priority) as con:
+                async with self._transaction(con, autocommit):
+                    with timed:
+                        result = await run(con, query, *value_dict.values(), timeout=self._timeout(timeout))
+        else:
+            async with self._transaction(con, autocommit):
+                with timed:
+                    result = await run(con, query, *value_dict.values(), timeout=self._timeout(timeout))
 
-            where_list = []
-            for key in where_dict.keys():
-                operator = '='
-                value = "'{}'".format(where_dict[key])
+        self._invalidate([table], con)
+        return result
 
-                split_key = key.split('__')
-                if len(split_key) > 1:
-                    column = split_key[0]
-                    spliter = split_key[1]
+    async def insert_many(self, con: Connection = None, table: str = '', rows=None, columns: list = None,
+                          chunk_size: int = 10000, returning: str = None, autocommit: bool = None):
+        '''
+        bulk insert through the binary COPY protocol
+        :param rows: list or async iterable of dicts or tuples, consumed in chunks of chunk_size
+        :param returning: columns to return for inserted rows, goes through a temp table when set
+        :return: number of inserted rows, or list of records when returning is set
+        '''
+        async def copy(con):
+            with self._timed('insert_many', table, 'COPY {}'.format(table)) as timed:
+                result = await self._insert_many(con, table, rows, columns, chunk_size, returning)
+                timed.rows = len(result) if returning else result
+            return result
 
-                    if spliter == 'in':
-                        operator = 'in'
-                        value = "({})".format(','.join(["'{}'".format(v) for v in where_dict[key]]))
+        if not con:
+            async with self.acquire() as con:
+                async with self._transaction(con, autocommit, single_statement=False):
+                    result = await copy(con)
+        else:
+            async with self._transaction(con, autocommit, single_statement=False):
+                result = await copy(con)
 
-                    if spliter == 'not_in':
-                        operator = 'not in'
-                        value = "({})".format(','.join(["'{}'".format(v) for v in where_dict[key]]))
+        self._invalidate([table], con)
+        return result
 
-                    if spliter == 'lt':
-                        operator = '<'
+    @staticmethod
+    async def _insert_many(con, table, rows, columns, chunk_size, returning):
+        if isinstance(returning, list):
+            returning = ','.join(returning)
+        schema_name, _, table_name = table.rpartition('.')
+        schema_name = schema_name or None
+        chunks = _RowChunks(rows, columns, chunk_size)
+
+        count = 0
+        results = []
+        temp_table = None
+        async for chunk in chunks:
+            if not returning:
+                await con.copy_records_to_table(table_name, records=chunk, columns=chunks.columns,
+                                                schema_name=schema_name)
+                count += len(chunk)
+                continue
+
+            column_list = ','.join(chunks.columns) if chunks.columns else '*'
+            if temp_table is None:
+                temp_table = '_{}_insert_many'.format(table_name)
+                await con.execute('CREATE TEMP TABLE {} ON COMMIT DROP AS SELECT {} FROM {} WITH NO DATA'.format(
+                    temp_table, column_list, table))
+            else:
+                await con.execute('TRUNCATE {}'.format(temp_table))
+            await con.copy_records_to_table(temp_table, records=chunk, columns=chunks.columns)
+            target = '{} ({})'.format(table, column_list) if chunks.columns else table
+            results.extend(await con.fetch('INSERT INTO {target} SELECT {columns} FROM {temp} '
+                                           'RETURNING {returning}'.format(target=target, columns=column_list,
+                                                                          temp=temp_table, returning=returning)))
+
+        if temp_table is not None:
+            # ON COMMIT DROP only fires at commit, another insert_many in the same transaction reuses the name
+            await con.execute('DROP TABLE {}'.format(temp_table))
+        return results if returning else count
+
+    async def column_types(self, table: str, con: Connection = None) -> dict:
+        '''
+        column name to sql type name of table, cached per adapter
+        '''
+        types = self._column_types.get(table)
+        if types is None:
+            query = 'SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute ' \
+                    'WHERE attrelid = $1::regclass AND attnum > 0 AND NOT attisdropped ORDER BY attnum'
+            if not con:
+                async with self.acquire() as con:
+                    rows = await con.fetch(query, table)
+            else:
+                rows = await con.fetch(query, table)
+            types = self._column_types[table] = {row[0]: row[1] for row in rows}
+        return types
+
+    async def upsert(self, con: Connection = None, table: str = '', rows: list = None, conflict_columns: list = None,
+                     update_columns: list = None, columns: list = None, returning=None, batch_size: int = 1000,
+                     autocommit: bool = None):
+        '''
+        INSERT ... ON CONFLICT DO UPDATE of many rows, sent as one array parameter per column and batch.
+        array typed columns are not supported
+        :param rows: list of dicts or tuples (tuples need columns)
+        :param update_columns: columns overwritten on conflict, defaults to every non conflict column,
+        an empty list means DO NOTHING
+        :param returning: columns to return, None returns the number of affected rows
+        rows repeating a conflict key would make postgres update a row twice in one statement, only the last of
+        them is written when updating (the first one with DO NOTHING)
+        '''
+        if not rows:
+            return [] if returning else 0
+        conflict_columns = tuple(conflict_columns)
+        if columns is None and isinstance(rows[0], dict):
+            columns = list(rows[0].keys())
+        if update_columns is None:
+            update_columns = [column for column in columns or () if column not in conflict_columns]
+        columns, batches = _column_batches(rows, columns, batch_size, conflict_columns if update_columns else None)
+
+        def build(types):
+            return _compile_upsert(table, columns, types, conflict_columns, tuple(update_columns),
+                                   _hashable_columns(returning))
+
+        return await self._write_batches('upsert', con, table, columns, batches, build, returning, autocommit)
+
+    async def update_many(self, con: Connection = None, table: str = '', rows: list = None, key_columns: list = None,
+                          columns: list = None, returning=None, batch_size: int = 1000, autocommit: bool = None):
+        '''
+        UPDATE ... FROM unnest(...) setting different values per row, matched on key_columns.
+        array typed columns are not supported
+        :param rows: list of dicts or tuples (tuples need columns), each including the key columns
+        :param returning: columns to return, None returns the number of updated rows
+        '''
+        if not rows:
+            return [] if returning else 0
+        key_columns = tuple(key_columns or ('id',))
+        columns, batches = _column_batches(rows, columns, batch_size)
+        missing = [column for column in key_columns if column not in columns]
+        if missing:
+            raise ValueError('key columns {} missing from the rows of {}'.format(missing, table))
+        if all(column in key_columns for column in columns):
+            raise ValueError('no columns to update in {} besides the key columns {}'.format(table, list(key_columns)))
+
+        def build(types):
+            return _compile_update_many(table, columns, types, key_columns, _hashable_columns(returning))
+
+        return await self._write_batches('update_many', con, table, columns, batches, build, returning, autocommit)
+
+    async def _write_batches(self, method, con, table, columns, batches, build, returning, autocommit):
+        if not con:
+            async with self.acquire() as con:
+                async with self._transaction(con, autocommit, single_statement=len(batches) <= 1):
+                    result = await self._run_batches(method, con, table, columns, batches, build, returning)
+        else:
+            async with self._transaction(con, autocommit, single_statement=len(batches) <= 1):
+                result = await self._run_batches(method, con, table, columns, batches, build, returning)
 
-                    if spliter == 'lte':
-                        operator = '<='
+        self._invalidate([table], con)
+        return result
 
-                    if spliter == 'gt':
-                        operator = '>'
+    async def _run_batches(self, method, con, table, columns, batches, build, returning):
+        types = await self.column_types(table, con)
+        query = build(tuple(types[column] for column in columns))
+
+        count = 0
+        results = []
+        with self._timed(method, table, query) as timed:
+            for batch in batches:
+                arrays = [list(values) for values in zip(*batch)]
+                if returning:
+                    results.extend(await con.fetch(query, *arrays))
+                else:
+                    status = await con.execute(query, *arrays)
+                    count += int(status.split()[-1])
+            timed.rows = len(results) if returning else count
+        return results if returning else count
+
+    async def update(self, con: Connection = None, table: str = '', where_dict: dict = None, options: dict = None,
+                     **update_params: dict):
+        '''
+        :param options: any of autocommit, timeout, priority and returning, kept out of update_params so every
+        column name can be written. returning is the columns of the updated rows to return, False for none
+        (returns the updated row count), defaults to the table's returning setting or *
+        '''
+        options = _call_options(options, UPDATE_OPTIONS)
+        autocommit = options.get('autocommit')
+        timeout = options.get('timeout')
+        priority = options.get('priority', PRIORITY_NORMAL)
+
+        values = ','.join(['{}=${}'.format(k, i) for i, k in enumerate(update_params.keys(), 1)])
+        args = list(update_params.values())
 
-                    if spliter == 'gte':
-                        operator = '>='
+        where = ''
+        if where_dict is not None:
+            where, where_args = self._where_query(where_dict, update_query=True, start=len(args) + 1)
+            args.extend(where_args)
+        returning = self._returning(table, options.get('returning'), '*')
+        query = self.UPDATE.format(table=table, values=values, where=where, returning=returning)
+        run = self._run_returning(returning)
+
+        async def statement(con):
+            with self._timed('update', table, query) as timed:
+                results = await run(con, query, *args, timeout=self._timeout(timeout))
+                timed.rows = len(results) if returning else results
+            return results
 
-                    if spliter == 'contains':
-                        operator = 'like'
-                        value = "'%{}%'".format(search_term)
+        if not con:
+            async with self.acquire(priority=priority) as con:
+                async with self._transaction(con, autocommit):
+                    results = await statement(con)
+        else:
+            async with self._transaction(con, autocommit):
+                results = await statement(con)
 
-                    if spliter == 'icontains':
-                        operator = 'ilike'
-                        value = "'%{}%'".format(search_term)
+        self._invalidate([table], con)
+        return results
 
-                    if spliter == 'startswith':
-                        operator = 'like'
-                        value = "'{}%'".format(search_term)
+    async def delete(self, con: Connection = None, table: str = '', where_dict: dict = None, autocommit: bool = None,
+                     timeout: float = None, priority: int = PRIORITY_NORMAL, returning=False, delete_all: bool = False):
+        '''
+        :param returning: columns of the deleted rows to return, nothing is returned by default
+        :param delete_all: required to delete every row, an empty or missing where_dict raises ValueError otherwise
+        '''
+        where, args = self._where_query(where_dict, update_query=True)
+        if not where.strip() and not delete_all:
+            raise ValueError('delete from {} without conditions, pass delete_all=True to delete every row'.format(
+                table))
+        returning = self._returning(table, returning, '*') if returning else ''
+        query = self.DELETE.format(table=table, where=where, returning=returning)
+        run = self._run_returning(returning)
+
+        async def statement(con):
+            with self._timed('delete', table, query) as timed:
+                results = await run(con, query, *args, timeout=self._timeout(timeout))
+                timed.rows = len(results) if returning else results
+            return results
 
-                    if spliter == 'istartswith':
-                        operator = 'ilike'
-                        value = "'{}%'".format(search_term)
+        if not con:
+            async with self.acquire(priority=priority) as con:
+                async with self._transaction(con, autocommit):
+                    results = await statement(con)
+        else:
+            async with self._transaction(con, autocommit):
+                results = await statement(con)
+
+        self._invalidate([table], con)
+        if returning:
+            return results
+
+    async def execute(self, con: Connection = None, query: str = '', tables: list = None, autocommit: bool = None,
+                      timeout: float = None, priority: int = PRIORITY_NORMAL):
+        '''
+        :param tables: tables written by query, used for result cache invalidation when they
+        can not be read from the query itself
+        '''
+        tables = tables or written_tables(query)
+        timed = self._timed('execute', ','.join(sorted(tables)) if tables else '', query)
+        if not con:
+            async with self.acquire(priority=priority) as con:
+                async with self._transaction(con, autocommit):
+                    with timed:
+                        await con.execute(query, timeout=self._timeout(timeout))
+        else:
+            async with self._transaction(con, autocommit):
+                with timed:
+                    await con.execute(query, timeout=self._timeout(timeout))
+
+        self._invalidate(tables, con)
+
+    async def search_index(self, table: str, columns: list, mode: str = SEARCH_FULLTEXT, config: str = 'english',
+                           create: bool = True, concurrently: bool = True) -> list:
+        '''
+        GIN indexes backing the fulltext and trigram search modes, trigram indexes also serve the default
+        ilike mode. trigram needs the pg_trgm extension, it is created when missing
+        :param create: create missing indexes, otherwise only report them
+        :param concurrently: build without blocking writes to table, False for the faster blocking build.
+        an invalid index left behind by a failed concurrent build counts as missing and is rebuilt
+        :return: names of the indexes that were missing
+        '''
+        if mode not in (SEARCH_FULLTEXT, SEARCH_TRIGRAM):
+            raise ValueError('unknown search mode "{}"'.format(mode))
+        if not re.match(r'^\w+$', config):
+            raise ValueError('invalid text search config "{}"'.format(config))
+
+        relation = table.split('.')[-1]
+        if mode == SEARCH_FULLTEXT:
+            indexes = {'{}_{}_fts_idx'.format(relation, '_'.join(columns))[:63]: '({})'.format(
+                _tsvector(columns, config))}
+        else:
+            indexes = {'{}_{}_trgm_idx'.format(relation, column)[:63]: '{} gin_trgm_ops'.format(column)
+                       for column in columns}
+
+        concurrently = 'CONCURRENTLY ' if concurrently else ''
+        async with self.acquire() as con:
+            # an index lives in the schema of its table, the same names may exist in other schemas
+            schema = await con.fetchval('SELECT relnamespace::regnamespace::text FROM pg_class '
+                                        'WHERE oid = $1::regclass', table)
+            existing = {row[0]: row[1] for row in await con.fetch(
+                'SELECT c.relname, i.indisvalid FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid '
+                'WHERE c.relname = any($1) AND c.relnamespace = $2::regnamespace', list(indexes), schema)}
+            missing = [name for name in indexes if not existing.get(name)]
+            if create and missing:
+                if mode == SEARCH_TRIGRAM:
+                    await con.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+                for name in missing:
+                    if name in existing:
+                        await con.execute('DROP INDEX {}IF EXISTS {}.{}'.format(concurrently, schema, name))
+                    await con.execute('CREATE INDEX {}IF NOT EXISTS {} ON {} USING gin ({})'.format(
+                        concurrently, name, table, indexes[name]))
+        return missing
+
+    async def select(self, table: str, offset=0, limit='ALL', order_by=None, columns='*',
+                     use_primary: bool = False, timeout: float = None, priority: int = PRIORITY_NORMAL,
+                     undefer: list = None, mapping=None, con: Connection = None) -> list:
+        '''
+        :param order_by: e.g. 'created desc, id', rows come in no particular order when None
+        :param con: runs on this connection, e.g. inside async_atomic to read the transaction's own writes,
+        instead of a replica (or the primary with use_primary) and without the result cache
+        '''
+        columns = await self._columns(table, columns, undefer)
+        query, args = self._select_query(table, columns, None, offset, None if limit == 'ALL' else limit, order_by)
+
+        results = await self._fetch('select', table, query, args, use_primary, timeout, priority, con)
+
+        return self._map(results, mapping)
+
+    async def where(self, table: str, offset=None, limit=None, order_by=None, columns='*', options: dict = None,
+                    **where_dict: dict) -> list:
+        '''
+        :param options: any of use_primary, timeout, priority, undefer, mapping and con (see select), kept out of
+        where_dict so every column name can be filtered on
+        '''
+        options = _call_options(options, WHERE_OPTIONS)
+        columns = await self._columns(table, columns, options.get('undefer'))
+        query, args = self._select_query(table, columns, where_dict, offset, limit, order_by)
+
+        results = await self._fetch('where', table, query, args, options.get('use_primary', False),
+                                    options.get('timeout'), options.get('priority', PRIORITY_NORMAL),
+                                    options.get('con'))
+
+        return self._map(results, options.get('mapping'))
+
+    async def keyset(self, table: str, order_by='id', after: str = None, limit: int = 100, columns='*',
+                     where_dict: dict = None, use_primary: bool = False, undefer: list = None,
+                     con: Connection = None) -> tuple:
+        '''
+        keyset pagination, order_by columns must identify a row uniquely (end with the primary key)
+        :param after: token returned by the previous page, None for the first page
+        :return: (rows, token for the next page or None on the last page)
+        '''
+        columns = await self._columns(table, columns, undefer)
+        order = _parse_order(order_by)
+        shape, args = _where_shape(where_dict, update_query=True)
+        query = _compile_keyset(self.SELECT, table, columns, shape, order, after is not None)
+        if after is not None:
+            args.extend(decode_keyset_token(after))
+        args.append(limit + 1)
+
+        results = await self._fetch('keyset', table, query, args, use_primary, con=con)
+
+        token = None
+        if len(results) > limit:
+            results = results[:limit]
+            token = encode_keyset_token([results[-1][column] for column, _ in order])
+        return results, token
+
+    async def count(self, table: str, where_dict: dict = None, use_primary: bool = False,
+                    con: Connection = None) -> int:
+        shape, args = _where_shape(where_dict, update_query=True)
+        query = _compile_select(self.SELECT, table, 'count(*)', shape)
+        return (await self._fetch('count', table, query, args, use_primary, con=con))[0][0]
+
+    async def exists(self, table: str, where_dict: dict = None, use_primary: bool = False,
+                     con: Connection = None) -> bool:
+        shape, args = _where_shape(where_dict, update_query=True)
+        query = 'SELECT exists({})'.format(_compile_select(self.SELECT, table, '1', shape))
+        return (await self._fetch('exists', table, query, args, use_primary, con=con))[0][0]
+
+    async def aggregate(self, table: str, aggregates: dict = None, group_by: list = None, order_by: str = None,
+                        where_dict: dict = None, use_primary: bool = False, con: Connection = None):
+        '''
+        :param aggregates: alias to (function, column), function is one of count, sum, min, max, avg
+        e.g. {'total': ('sum', 'amount'), 'orders': ('count', '*')}, defaults to {'count': ('count', '*')}
+        :param group_by: columns to group by, selected alongside the aggregates
+        :return: one record, or a list of records per group when group_by is set
+        '''
+        aggregates = aggregates or {'count': ('count', '*')}
+        shape, args = _where_shape(where_dict, update_query=True)
+        query = _compile_aggregate(table, tuple(sorted(aggregates.items())), tuple(group_by or ()), shape, order_by)
+        results = await self._fetch('aggregate', table, query, args, use_primary, con=con)
+        return results if group_by else results[0]
+
+    async def estimated_count(self, table: str, where_dict: dict = None, use_primary: bool = False,
+                              con: Connection = None) -> int:
+        '''
+        row count from planner statistics, pg_class.reltuples for a whole table
+        or the EXPLAIN row estimate when filtered with where lookups
+        '''
+        if con is None:
+            async with self.acquire(readonly=not use_primary) as con:
+                return await self.estimated_count(table, where_dict, con=con)
+
+        if not where_dict:
+            estimate = await con.fetchval('SELECT reltuples::bigint FROM pg_class WHERE oid = $1::regclass', table)
+            if estimate is not None and estimate >= 0:
+                return estimate
+
+        query, args = self._select_query(table, '1', where_dict)
+        plan = await con.fetchval('EXPLAIN (FORMAT JSON) ' + query, *args)
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return plan[0]['Plan']['Plan Rows']
+
+    def paginate(self, table: str, order_by='id', page_size: int = 1000, **kwargs) -> KeysetPages:
+        '''
+        async iterator over every page of table, see keyset
+        '''
+        return KeysetPages(self, table, order_by, page_size, kwargs)
+
+    def stream(self, query: str, *args, prefetch: int = 1000, batch_size: int = None,
+               use_primary: bool = False) -> RecordStream:
+        '''
+        server side cursor over query fetching prefetch rows per round trip,
+        yields lists of up to batch_size records when batch_size is set
+        '''
+        return RecordStream(self, query, args, prefetch=prefetch, batch_size=batch_size, use_primary=use_primary)
+
+    def column_batches(self, table: str, columns='*', offset=None, limit=None, order_by=None,
+                       where_dict: dict = None, batch_size: int = 100000,
+                       use_primary: bool = False) -> ColumnStream:
+        '''
+        columnar read of table filtered with where lookups, needs numpy.
+        integer, float, bool, timestamp and date columns are decoded from binary COPY straight into arrays,
+        result sets with other types (text becomes an object array) are read through a cursor.
+        the read holds a connection until the stream is exhausted or closed, use it as an async context manager
+        when breaking out early
+        :return: async iterator of ColumnBatch of up to batch_size rows
+        '''
+        if isinstance(columns, list):
+            columns = ','.join(columns)
+        query, args = self._select_query(table, columns, where_dict, offset, limit, order_by)
+        return ColumnStream(self, table, query, args, batch_size=batch_size, use_primary=use_primary)
+
+    async def fetch_columns(self, table: str, columns='*', offset=None, limit=None, order_by=None,
+                            where_dict: dict = None, use_primary: bool = False) -> ColumnBatch:
+        '''
+        same as column_batches, as one ColumnBatch
+        '''
+        return await self.column_batches(table, columns, offset, limit, order_by, where_dict,
+                                         use_primary=use_primary).fetch()
+
+    async def export(self, output, table: str = '', query: str = '', columns='*', format: str = 'csv',
+                     header: bool = True, use_primary: bool = False, where_dict: dict = None) -> str:
+        '''
+        streams COPY ... TO STDOUT of query, or of table filtered with where lookups, into output
+        :param output: path, file-like object or coroutine function called with each chunk of bytes
+        :param format: csv, text or binary
+        :return: COPY status string
+        '''
+        args = []
+        if not query:
+            if isinstance(columns, list):
+                columns = ','.join(columns)
+            query, args = self._select_query(table, columns, where_dict)
+
+        options = {'format': format}
+        if format == 'csv':
+            options['header'] = header
+
+        async with self.acquire(readonly=not use_primary) as con:
+            with self._timed('export', table, query):
+                status = await con.copy_from_query(query, *args, output=output, **options)
+        return status
+
+    def loader(self, table: str, key: str = 'id', columns='*', **options) -> BatchLoader:
+        '''
+        shared BatchLoader for table and key, options are passed to BatchLoader on first use
+        '''
+        loader_key = (table, key, ','.join(columns) if isinstance(columns, list) else columns)
+        loader = self._loaders.get(loader_key)
+        if loader is None:
+            loader = self._loaders[loader_key] = BatchLoader(self, table, key=key, columns=columns, **options)
+        return loader
+
+    async def load(self, table: str, value, key: str = 'id', columns='*'):
+        '''
+        single row lookup by key, batched with concurrent loads on the same table and key
+        '''
+        return await self.loader(table, key=key, columns=columns).load(value)
+
+    def writer(self, **options) -> BufferedWriter:
+        '''
+        shared write-behind BufferedWriter, options are passed to BufferedWriter on first use
+        '''
+        if self._writer is None:
+            self._writer = BufferedWriter(self, **options)
+            if isinstance(self.metrics, Metrics):
+                self.metrics.writer = self._writer
+        return self._writer
+
+    def write(self, table: str, row, columns: list = None) -> bool:
+        '''
+        buffers row for a background insert into table, see BufferedWriter
+        '''
+        return self.writer().write(table, row, columns)
+
+    def change_feed(self, **options) -> ChangeFeed:
+        '''
+        shared ChangeFeed on a dedicated primary connection, options are passed to ChangeFeed on first use
+        '''
+        if self._feed is None:
+            self._feed = ChangeFeed(self._params, **options)
+        return self._feed
+
+    async def subscribe(self, channel: str, queue_size: int = None, decode=None) -> Subscription:
+        '''
+        LISTEN to channel, see ChangeFeed
+        :return: Subscription, an async iterator over the channel's payloads
+        '''
+        return await self.change_feed().subscribe(channel, queue_size=queue_size, decode=decode)
+
+    async def notify(self, channel: str, payload: str = ''):
+        async with self.acquire() as con:
+            await con.execute('SELECT pg_notify($1, $2)', channel, payload)
+
+    async def notify_trigger(self, table: str, channel: str = None, columns: list = None) -> str:
+        '''
+        installs a trigger publishing row changes of table, see notify_trigger_ddl
+        :return: the channel to subscribe to
+        '''
+        channel = channel or _channel_name(table)
+        async with self.acquire() as con:
+            await con.execute(notify_trigger_ddl(table, channel, columns))
+        return channel
+
+    async def drop_notify_trigger(self, table: str):
+        async with self.acquire() as con:
+            await con.execute(drop_notify_trigger_ddl(table))
+
+    async def close(self):
+        '''
+        stops the change feed, flushes the write-behind buffer and closes every pool
+        '''
+        if self._feed is not None:
+            await self._feed.close()
+            self._feed = None
+        if self._writer is not None:
+            await self._writer.close()
+        if self.replicas is not None:
+            await self.replicas.close()
+        pool, self.pool = self.pool, None
+        if pool is not None:
+            await pool.close()
+
+    def _map(self, records: list, mapping=None) -> list:
+        '''
+        :param mapping: see map_rows, None uses the adapter's row_mapping and False keeps records
+        '''
+        if mapping is None:
+            mapping = self.row_mapping
+        return map_rows(records, mapping) if mapping else records
+
+    async def _columns(self, table: str, columns, undefer: list = None) -> str:
+        '''
+        select list, * leaves out the table's deferred columns unless they are listed in undefer
+        '''
+        if isinstance(columns, list):
+            return ','.join(columns)
+        if columns != '*' or table not in self.deferred:
+            return columns
+
+        key = (table, tuple(undefer or ()))
+        projection = self._projections.get(key)
+        if projection is None:
+            skip = set(self.deferred[table]) - set(undefer or ())
+            names = [column for column in await self.column_types(table) if column not in skip]
+            projection = self._projections[key] = ','.join(names) if skip else '*'
+        return projection
+
+    async def _fetch(self, method: str, table: str, query: str, args: list, use_primary: bool = False,
+                     timeout: float = None, priority: int = PRIORITY_NORMAL, con: Connection = None) -> list:
+        use_primary = use_primary or con is not None
+        cache = self.cache if not use_primary else None
+        if cache is not None:
+            self.flush_invalidations()
+            results = cache.get(table, query, args)
+            if results is not MISS:
+                return results
+            generation = cache.generation(table)
+
+        timed = self._timed(method, table, query)
+        if con is not None:
+            with timed:
+                results = await con.fetch(query, *args, timeout=self._timeout(timeout))
+                timed.rows = len(results)
+        else:
+            async with self.acquire(readonly=not use_primary, priority=priority) as con:
+                with timed:
+                    try:
+                        results = await con.fetch(query, *args, timeout=self._timeout(timeout))
+                    except STATEMENT_ERRORS:
+                        # a pooler switched server connections under a cached statement, drop the cache and
+                        # retry once
+                        await con.reload_schema_state()
+                        results = await con.fetch(query, *args, timeout=self._timeout(timeout))
+                    timed.rows = len(results)
+        if self.advisor is not None:
+            self.advisor.observe(method, table, query, args, timed.elapsed, use_primary)
+
+        if cache is not None:
+            cache.set(table, query, args, results, generation)
+        return results
 
-                    if spliter == 'endswith':
-                        operator = 'like'
-                        value = "'%{}'".format(search_term)
+    def _invalidate(self, tables, con: Connection = None):
+        '''
+        writes on a connection inside a transaction invalidate once it ends, so a read between the write and
+        the commit can not cache the old rows again. they are flushed when the adapter releases the connection,
+        after async_atomic commits, before the next cached read or write and by flush_invalidations
+        '''
+        if self.cache is None:
+            return
+        self.flush_invalidations()
+        if con is not None and _in_transaction(con):
+            pending = self._pending_invalidations.setdefault(con, set())
+            if tables is None or None in pending:
+                pending.clear()
+                pending.add(None)
+            else:
+                pending.update(tables)
+            return
+        self.cache.invalidate(tables)
+
+    def flush_invalidations(self, con: Connection = None):
+        '''
+        invalidates the tables written inside transactions that have ended, or inside the transaction of con
+        whether it ended or not (it is about to end).
+        a replica lagging behind the primary can still serve and cache the old rows after the commit,
+        tables read from replicas need a ttl shorter than the replication lag that is acceptable
+        '''
+        if not self._pending_invalidations:
+            return
+        if con is not None:
+            ended = [con] if con in self._pending_invalidations else []
+        else:
+            ended = [con for con in self._pending_invalidations if not _in_transaction(con)]
+        for ended_con in ended:
+            tables = self._pending_invalidations.pop(ended_con)
+            self.cache.invalidate(None if None in tables else tables)
 
-                    if spliter == 'iendswith':
-                        operator = 'ilike'
-                        value = "'%{}'".format(search_term)
+    @classmethod
+    def _select_query(cls, table, columns, where_dict, offset=None, limit=None, order_by=None):
+        shape, args = _where_shape(where_dict, offset, limit, order_by)
+        return _compile_select(cls.SELECT, table, columns, shape), args
 
-                else:
-                    column = key
-
-                placeholder = "{} {} {}".format(column, operator, value)
-                where_list.append(placeholder)
-            if where_list:
-                where_query = ' and '.join(where_list)
-
-            if search_query and where_query:
-                query += ' (' + search_query + ') and (' + where_query + ') '
-            elif search_query and where_query is None:
-                query += search_query
-            elif where_query and search_query is None:
-                query += where_query
-
-        if not update_query:
-            if order_by:
-                query += ' order by {}'.format(order_by)
-            if offset:
-                query += ' offset {}'.format(offset)
-            if limit:
-                query += ' limit {}'.format(limit)
-
-        return query
+    @staticmethod
+    def _where_query(where_dict, offset=None, limit=None, order_by=None, update_query=False, start=1):
+        shape, args = _where_shape(where_dict, offset, limit, order_by, update_query, start)
+        return _compile_where(*shape), args
 
     def _compat(self):
         ld = {}
-        s = '''async def iterate(self, query: str):
-            pool = await self.get_pool()
-            async with pool.acquire() as con:
+        s = '''async def iterate(self, query: str, *args, prefetch: int = None, use_primary: bool = False):
+            async with self.acquire(readonly=not use_primary) as con:
                 async with con.transaction():
-                    async for record in con.cursor(query):
+                    async for record in con.cursor(query, *args, prefetch=prefetch):
                         yield record'''
 
         exec(s, None, ld)
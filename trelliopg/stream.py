@@ -0,0 +1,89 @@
+import collections
+
+
+class RecordStream:
+    '''
+    server side cursor over a query, fetching prefetch rows per round trip.
+    iterates over records, or over lists of up to batch_size records when batch_size is set.
+    the connection is held until the stream is exhausted or closed, use it as an async context manager
+    when breaking out early
+    '''
+
+    def __init__(self, adapter, query: str, args=(), prefetch: int = 1000, batch_size: int = None,
+                 use_primary: bool = False):
+        self.adapter = adapter
+        self.query = query
+        self.args = args
+        self.prefetch = batch_size or prefetch
+        self.batch_size = batch_size
+        self.use_primary = use_primary
+
+        self._acquire = None
+        self._transaction = None
+        self._cursor = None
+        self._buffer = collections.deque()
+        self._exhausted = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close(exc_type, exc_val, exc_tb)
+
+    def __aiter__(self):
+        return self
+
+    async def _open(self):
+        acquire = self.adapter.acquire(readonly=not self.use_primary)
+        con = await acquire.__aenter__()
+        self._acquire = acquire
+        try:
+            transaction = con.transaction()
+            await transaction.start()
+            self._transaction = transaction
+            self._cursor = await con.cursor(self.query, *self.args)
+        except BaseException as e:
+            await self.close(type(e), e, e.__traceback__)
+            raise
+
+    async def _fetch(self) -> list:
+        if self._exhausted:
+            return []
+        if self._cursor is None:
+            await self._open()
+        try:
+            rows = await self._cursor.fetch(self.prefetch)
+        except BaseException as e:
+            await self.close(type(e), e, e.__traceback__)
+            raise
+        if len(rows) < self.prefetch:
+            await self.close()
+        return rows
+
+    async def __anext__(self):
+        if self.batch_size:
+            rows = await self._fetch()
+            if not rows:
+                raise StopAsyncIteration
+            return rows
+
+        if not self._buffer:
+            self._buffer.extend(await self._fetch())
+            if not self._buffer:
+                raise StopAsyncIteration
+        return self._buffer.popleft()
+
+    async def close(self, exc_type=None, exc_val=None, exc_tb=None):
+        self._exhausted = True
+        self._cursor = None
+        transaction, self._transaction = self._transaction, None
+        acquire, self._acquire = self._acquire, None
+        try:
+            if transaction is not None:
+                if exc_type is None:
+                    await transaction.commit()
+                else:
+                    await transaction.rollback()
+        finally:
+            if acquire is not None:
+                await acquire.__aexit__(exc_type, exc_val, exc_tb)
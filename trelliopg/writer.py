@@ -0,0 +1,205 @@
+import asyncio
+import collections
+import time
+
+from .metrics import Histogram
+from .pool import PRIORITY_BACKGROUND
+
+COPY = 'copy'
+INSERT = 'insert'
+
+DROP_NEWEST = 'drop_newest'
+DROP_OLDEST = 'drop_oldest'
+BLOCK = 'block'
+RAISE = 'raise'
+
+
+class WriterOverflowError(Exception):
+    pass
+
+
+class BufferedWriter:
+    '''
+    write-behind inserter, write() buffers a row per table and returns immediately.
+    a background task flushes a table once it holds max_rows rows and every table each flush_interval seconds,
+    with COPY or a batched multi-row INSERT on a background priority connection.
+
+    at most max_buffered rows are held over all tables, overflow decides what happens to further rows:
+    drop_newest or drop_oldest discard a row, raise raises WriterOverflowError, block makes put() wait for a flush.
+    rows of a failed flush are retried up to retries times, retry_delay seconds after the first failure and twice
+    as long after each further one, and then passed to on_error(table, rows, exc).
+    exceptions raised by on_error are counted in callback_errors, they never stop the flush task
+    '''
+
+    def __init__(self, adapter, max_rows: int = 1000, flush_interval: float = 1.0, max_buffered: int = 100000,
+                 overflow: str = DROP_NEWEST, method: str = COPY, retries: int = 2, retry_delay: float = 0.1,
+                 on_error=None):
+        if overflow not in (DROP_NEWEST, DROP_OLDEST, BLOCK, RAISE):
+            raise ValueError('unknown overflow policy "{}"'.format(overflow))
+        if method not in (COPY, INSERT):
+            raise ValueError('unknown flush method "{}"'.format(method))
+
+        self.adapter = adapter
+        self.max_rows = max_rows
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self.overflow = overflow
+        self.method = method
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.on_error = on_error
+
+        self.buffered = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.callback_errors = 0
+        self.flush_latency = Histogram()
+
+        self._buffers = collections.OrderedDict()
+        self._task = None
+        self._wake = None
+        self._room = None
+        self._closed = False
+
+    def write(self, table: str, row, columns: list = None) -> bool:
+        '''
+        :param row: dict, or tuple in the order of columns
+        :return: False when the row was dropped
+        '''
+        if self._closed:
+            raise RuntimeError('writer is closed')
+        if self.buffered >= self.max_buffered:
+            if self.overflow in (RAISE, BLOCK):
+                raise WriterOverflowError('{} rows already buffered'.format(self.buffered))
+            if self.overflow == DROP_NEWEST or not self._drop_oldest():
+                self.dropped += 1
+                return False
+
+        if isinstance(row, dict):
+            columns = tuple(row.keys())
+            row = tuple(row.values())
+        else:
+            columns = tuple(columns)
+
+        key = (table, columns)
+        buffer = self._buffers.get(key)
+        if buffer is None:
+            buffer = self._buffers[key] = collections.deque()
+        buffer.append(row)
+        self.buffered += 1
+
+        self._start()
+        if len(buffer) >= self.max_rows:
+            self._wake.set()
+        return True
+
+    async def put(self, table: str, row, columns: list = None) -> bool:
+        '''
+        same as write, but waits for room instead of raising when overflow is block
+        '''
+        while self.overflow == BLOCK and self.buffered >= self.max_buffered and not self._closed:
+            self._start()
+            self._wake.set()
+            await self._room.wait()
+        return self.write(table, row, columns)
+
+    def _drop_oldest(self) -> bool:
+        for key, buffer in self._buffers.items():
+            if buffer:
+                buffer.popleft()
+                self.buffered -= 1
+                self.dropped += 1
+                return True
+        return False
+
+    def _start(self):
+        if self._task is None:
+            self._wake = asyncio.Event()
+            self._room = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+                full_only = self.buffered < self.max_buffered
+            except asyncio.TimeoutError:
+                full_only = False
+            self._wake.clear()
+            await self.flush(full_only)
+            if self._closed:
+                return
+
+    async def flush(self, full_only: bool = False):
+        '''
+        writes buffered rows now
+        :param full_only: only flush tables holding at least max_rows rows
+        '''
+        keys = [key for key, buffer in self._buffers.items()
+                if buffer and (not full_only or len(buffer) >= self.max_rows)]
+        for key in keys:
+            rows = list(self._buffers.pop(key))
+            self.buffered -= len(rows)
+            if self._room is not None:
+                self._room.set()
+                self._room.clear()
+            await self._flush(key[0], list(key[1]), rows)
+
+    async def _flush(self, table: str, columns: list, rows: list):
+        for attempt in range(self.retries + 1):
+            started = time.monotonic()
+            try:
+                async with self.adapter.acquire(priority=PRIORITY_BACKGROUND) as con:
+                    if self.method == COPY:
+                        await self.adapter.insert_many(con, table, rows, columns)
+                    else:
+                        await self._insert(con, table, columns, rows)
+            except Exception as e:
+                if attempt < self.retries:
+                    await asyncio.sleep(self.retry_delay * 2 ** attempt)
+                    continue
+                self.failed += len(rows)
+                if self.on_error is not None:
+                    try:
+                        self.on_error(table, rows, e)
+                    except Exception:
+                        self.callback_errors += 1
+            else:
+                self.flush_latency.observe(time.monotonic() - started)
+                self.written += len(rows)
+                return
+
+    async def _insert(self, con, table: str, columns: list, rows: list):
+        query = self.adapter.INSERT.format(table=table, columns=','.join(columns), returning='',
+                                           values=','.join('${}'.format(i + 1) for i in range(len(columns))))
+        async with self.adapter._transaction(con, single_statement=False):
+            with self.adapter._timed('insert', table, query, len(rows)):
+                await con.executemany(query, rows)
+        self.adapter._invalidate([table])
+
+    def queue_depth(self) -> dict:
+        '''
+        buffered rows per table
+        '''
+        depth = collections.Counter()
+        for (table, _), buffer in self._buffers.items():
+            depth[table] += len(buffer)
+        return dict(depth)
+
+    def stats(self) -> dict:
+        return {'buffered': self.buffered, 'written': self.written, 'dropped': self.dropped, 'failed': self.failed,
+                'callback_errors': self.callback_errors, 'queue_depth': self.queue_depth()}
+
+    async def close(self):
+        '''
+        stops accepting rows and flushes everything still buffered
+        '''
+        self._closed = True
+        if self._task is not None:
+            self._wake.set()
+            await self._task
+            self._task = None
+        await self.flush()
+        if self._room is not None:
+            self._room.set()